@@ -1,10 +1,8 @@
 # -*- coding: utf-8 -*-
 import rapidsms
-import datetime
 
 from rapidsms.apps.base import AppBase
-from .models import Poll
-from django.db.models import Q
+from .models import Poll, ActivePoll
 from rapidsms_httprouter.models import Message, MessageBatch
 
 import logging
@@ -36,14 +34,13 @@ class App(AppBase):
 
         if (message.connection.contact):
             try:
-                poll = Poll.objects.filter(contacts=message.connection.contact).exclude(start_date=None)\
-                    .filter(Q(end_date=None) | (~Q(end_date=None) & Q(end_date__gt=datetime.datetime.now())))\
-                    .latest('start_date')
+                poll = ActivePoll.objects.get_poll_for(message.connection.contact)
 
                 log.debug("[poll-app] Found poll for message [{}]".format(str(poll)))
 
-                if  poll.responses.filter(contact=message.connection.contact).exists():
-                    old_response=poll.responses.filter(contact=message.connection.contact)[0]
+                old_responses = list(poll.responses.filter(contact=message.connection.contact)[:1])
+                if old_responses:
+                    old_response=old_responses[0]
                     log.debug("[poll-app] Processing response again (theres already one from this contact)")
                     response_obj, response_msg = poll.process_response(message)
                     if poll.response_type == Poll.RESPONSE_TYPE_ONE :
@@ -0,0 +1,85 @@
+import re
+import time
+
+import logging
+
+from .keywords import parse_keyword_rule, KeywordAutomaton, KeywordHits
+
+log = logging.getLogger(__name__)
+
+
+class Categorizer(object):
+    """
+    The categories and rules of a poll, with every rule's regex compiled once,
+    ready to sort incoming text into categories.  Polls build one of these
+    from their Category and Rule rows (see Poll.get_categorizer) and keep it
+    until a category or rule changes.
+
+    Rules that are plain keyword lists (Starts With, Contains,
+    contains_one_of and contains_all_of) are answered from a single pass of
+    a keyword automaton over the text instead of one regex each, for texts
+    on a single line; multi-line texts go through the regexes.
+    """
+
+    def __init__(self, categories, rules, time_budget=None):
+        """
+        ``categories`` are the poll's categories in the order they should be
+        tried, ``rules`` an iterable of (category pk, regex) pairs.  If
+        categorizing a message takes more than ``time_budget`` seconds it is
+        given up and the message put in the default category.  The budget is
+        best-effort only: the deadline is checked between rules, as a running
+        match can't be interrupted, so a single runaway regex still takes as
+        long as it takes; Rule.save() and Poll.build_categorizer keep those
+        out.
+        """
+        self.time_budget = time_budget
+        self.categories = list(categories)
+        self.default = None
+        for category in self.categories:
+            if category.default:
+                self.default = category
+                break
+
+        compiled = {}
+        keywords = set()
+        for category_id, regex in rules:
+            try:
+                keyword_rule = parse_keyword_rule(regex)
+                compiled.setdefault(category_id, []).append((re.compile(regex, re.IGNORECASE), keyword_rule))
+            except re.error:
+                log.warn("[categorizer] ignoring invalid rule regex [%s]" % regex)
+                continue
+            if keyword_rule:
+                keywords.update(keyword_rule[1])
+        # (category, [(compiled regex, (kind, keywords) or None)])
+        self.rules = [(category, compiled[category.pk]) for category in self.categories
+                      if category.pk in compiled]
+        self.automaton = KeywordAutomaton(sorted(keywords)) if keywords else None
+
+    def categorize(self, text):
+        """
+        Returns the list of categories that ``text`` falls into (those with at
+        least one matching rule), in category order.
+        """
+        if not text:
+            return []
+        text = text.lower()
+        deadline = self.time_budget and time.time() + self.time_budget
+        hits = None
+        if self.automaton and '\n' not in text:
+            hits = KeywordHits(self.automaton, text)
+        matches = []
+        for category, rules in self.rules:
+            for regex, keyword_rule in rules:
+                if keyword_rule and hits is not None:
+                    if hits.matches(*keyword_rule):
+                        matches.append(category)
+                        break
+                    continue
+                if deadline and time.time() > deadline:
+                    log.warn("[categorizer] gave up on [%s] after %ss, using the default category" % (text, self.time_budget))
+                    return [self.default] if self.default else []
+                if regex.search(text):
+                    matches.append(category)
+                    break
+        return matches
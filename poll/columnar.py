@@ -0,0 +1,126 @@
+import calendar
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+from eav.models import Attribute
+
+from .models import Poll
+from .export import iter_response_chunks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the per-response columns and their types; missing ids are -1, missing
+# numbers NaN and missing dates NaT
+COLUMNS = (
+    ('response_id', 'int64'),
+    ('contact_id', 'int64'),
+    ('date', 'int64'),
+    ('location_id', 'int64'),
+    ('value_number', 'float64'),
+    ('value_text', 'int32'),
+    ('value_location', 'int64'),
+    ('category_count', 'int64'),
+)
+
+NAT = -2 ** 63
+
+
+def _microseconds(date):
+    if date is None:
+        return NAT
+    return calendar.timegm(date.timetuple()) * 1000000 + date.microsecond
+
+
+def build_columns(poll, chunk_size=None):
+    """
+    Returns the responses of ``poll`` as a dict of numpy arrays, read a
+    chunk at a time with iter_response_chunks:
+
+    * response_id, contact_id, location_id (the contact's reporting
+      location), date (datetime64[us]) and value_number, value_location
+      (a location id) one entry per response
+    * value_text, codes into the value_text_dictionary array of texts
+    * category_ids, the ids of every response's categories one after the
+      other, those of response i being category_ids[category_offsets[i]:
+      category_offsets[i + 1]]
+    * category_dictionary_id and category_dictionary_name, the poll's
+      categories
+    """
+    if numpy is None:
+        raise ImproperlyConfigured("Columnar exports need numpy")
+    db_type = Poll.TYPE_CHOICES[poll.type]['db_type']
+    parts = dict([(name, []) for name, dtype in COLUMNS])
+    parts['category_ids'] = []
+    texts = {}
+
+    for chunk in iter_response_chunks(poll, chunk_size):
+        columns = dict([(name, []) for name, dtype in COLUMNS])
+        category_ids = []
+        for row in chunk:
+            value = row['value']
+            columns['response_id'].append(row['id'])
+            columns['contact_id'].append(row['contact_id'] or -1)
+            columns['date'].append(_microseconds(row['date']))
+            columns['location_id'].append(row['location_id'] or -1)
+            if db_type == Attribute.TYPE_FLOAT and value is not None:
+                columns['value_number'].append(value)
+            else:
+                columns['value_number'].append(float('nan'))
+            if db_type == Attribute.TYPE_TEXT and value is not None:
+                columns['value_text'].append(texts.setdefault(value, len(texts)))
+            else:
+                columns['value_text'].append(-1)
+            if db_type == Attribute.TYPE_OBJECT and value is not None:
+                columns['value_location'].append(value)
+            else:
+                columns['value_location'].append(-1)
+            columns['category_count'].append(len(row['categories']))
+            category_ids.extend([category_id for category_id, name in row['categories']])
+        for name, dtype in COLUMNS:
+            parts[name].append(numpy.array(columns[name], dtype=dtype))
+        parts['category_ids'].append(numpy.array(category_ids, dtype='int64'))
+
+    arrays = {}
+    for name, dtype in COLUMNS + (('category_ids', 'int64'),):
+        arrays[name] = numpy.concatenate(parts[name]) if parts[name] else numpy.zeros(0, dtype=dtype)
+    arrays['date'] = arrays['date'].view('datetime64[us]')
+    arrays['category_offsets'] = numpy.concatenate([numpy.zeros(1, dtype='int64'),
+                                                    numpy.cumsum(arrays.pop('category_count'))]).astype('int64')
+
+    dictionary = [None] * len(texts)
+    for text, code in texts.items():
+        dictionary[code] = text
+    arrays['value_text_dictionary'] = numpy.array(dictionary, dtype=unicode) if dictionary \
+        else numpy.zeros(0, dtype='U1')
+    categories = list(poll.categories.order_by('pk').values_list('pk', 'name'))
+    arrays['category_dictionary_id'] = numpy.array([pk for pk, name in categories], dtype='int64')
+    arrays['category_dictionary_name'] = numpy.array([name for pk, name in categories], dtype=unicode) \
+        if categories else numpy.zeros(0, dtype='U1')
+    return arrays
+
+
+def write_npz(poll, file, chunk_size=None):
+    """
+    Writes the columns of ``poll`` to ``file`` (a path or a file object) in
+    numpy's .npz format.
+    """
+    numpy.savez(file, **build_columns(poll, chunk_size))
+
+
+def write_npy_directory(poll, directory, chunk_size=None):
+    """
+    Writes each column of ``poll`` to its own .npy file in ``directory``,
+    which numpy.load(path, mmap_mode='r') can map without reading it in.
+    Returns the paths written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for name, array in sorted(build_columns(poll, chunk_size).items()):
+        path = os.path.join(directory, '%s.npy' % name)
+        numpy.save(path, array)
+        paths.append(path)
+    return paths
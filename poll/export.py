@@ -0,0 +1,218 @@
+import csv
+import cStringIO
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.contrib.contenttypes.models import ContentType
+from eav.models import Value, Attribute
+from rapidsms.models import Contact
+from rapidsms.contrib.locations.models import Location
+
+from .models import Poll, Response, ResponseCategory
+
+# the eav attribute and Value column holding a response's value, by the
+# db_type of its poll type
+VALUE_COLUMNS = {
+    Attribute.TYPE_TEXT: ('poll_text_value', 'value_text'),
+    Attribute.TYPE_FLOAT: ('poll_number_value', 'value_float'),
+    Attribute.TYPE_OBJECT: ('poll_location_value', 'generic_value_id'),
+}
+
+RESPONSE_COLUMNS = ('pk', 'date', 'message__date', 'message__connection__identity',
+                    'message__connection__contact', 'message__connection__contact__reporting_location',
+                    'modified')
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def iter_response_chunks(poll, chunk_size=None, descending=False, responses=None):
+    """
+    Yields the responses of ``poll`` (or the ``responses`` queryset of them)
+    in pk order as lists of at most ``chunk_size`` dicts, with the message's
+    contact, the response's value (a text, a number or a location pk,
+    depending on the poll type) and its (category pk, name) pairs, for a
+    fixed number of queries per chunk.  Chunks are read by keyset on the pk,
+    so memory use doesn't grow with the size of the poll.
+    """
+    chunk_size = chunk_size or getattr(settings, 'POLL_EXPORT_CHUNK_SIZE', 500)
+    if responses is None:
+        responses = poll.responses.all()
+    responses = responses.order_by('-pk' if descending else 'pk').values_list(*RESPONSE_COLUMNS)
+    last_pk = None
+    while True:
+        chunk = responses
+        if last_pk is not None:
+            chunk = chunk.filter(**{'pk__lt' if descending else 'pk__gt': last_pk})
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        yield _load_chunk(poll, chunk)
+
+
+def _load_chunk(poll, chunk):
+    response_ids = [row[0] for row in chunk]
+    contacts = Contact.objects.in_bulk(set([row[4] for row in chunk if row[4]]))
+
+    values = {}
+    db_type = Poll.TYPE_CHOICES[poll.type]['db_type']
+    if db_type in VALUE_COLUMNS:
+        slug, column = VALUE_COLUMNS[db_type]
+        values = dict(Value.objects.filter(entity_ct=ContentType.objects.get_for_model(Response),
+                                           attribute__slug=slug, entity_id__in=response_ids)
+                      .values_list('entity_id', column))
+
+    categories = {}
+    for response_id, category_id, name in ResponseCategory.objects.filter(response__in=response_ids)\
+            .order_by('pk').values_list('response', 'category', 'category__name'):
+        categories.setdefault(response_id, []).append((category_id, name))
+
+    return [{
+        'id': pk,
+        'date': date,
+        'message_date': message_date,
+        'identity': identity,
+        'contact_id': contact_id,
+        'contact': contacts.get(contact_id),
+        'location_id': location_id,
+        'value': values.get(pk),
+        'categories': categories.get(pk, []),
+        'modified': modified,
+    } for pk, date, message_date, identity, contact_id, location_id, modified in chunk]
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+
+def _csv_columns(poll, chunk):
+    """
+    Yields each response dict of ``chunk`` with its sender, time, value and
+    categories columns as in responses_as_csv.
+    """
+    names = {}
+    is_location = Poll.TYPE_CHOICES[poll.type]['db_type'] == Attribute.TYPE_OBJECT
+    if is_location:
+        names = dict(Location.objects.filter(pk__in=set([row['value'] for row in chunk if row['value']]))
+                     .values_list('pk', 'name'))
+    for row in chunk:
+        value = names.get(row['value']) if is_location else row['value']
+        yield row, [
+            _encode(row['contact'] or row['identity']),
+            row['message_date'].strftime('%d/%m/%Y %H:%M') if row['message_date'] else '',
+            _encode(value),
+            _encode(''.join(['%s,' % name for category_id, name in row['categories']])),
+        ]
+
+
+def iter_responses_csv(poll, chunk_size=None, progress=None):
+    """
+    Yields the responses_as_csv export of ``poll``, newest responses first,
+    a chunk of rows at a time; the header comes out before any response is
+    read.  ``progress`` is called with the number of rows written so far
+    after each chunk.
+    """
+    buffer = cStringIO.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    writer.writerow(['sender', 'time', 'value', 'categories'])
+    yield flush()
+    rows = 0
+    for chunk in iter_response_chunks(poll, chunk_size, descending=True):
+        for row, columns in _csv_columns(poll, chunk):
+            writer.writerow(columns)
+        rows += len(chunk)
+        if progress:
+            progress(rows)
+        yield flush()
+
+
+def parse_cursor(since):
+    """
+    Reads the ``since`` of an incremental export: a cursor handed out by an
+    earlier export, a date ('2013-05-01' or '2013-05-01T08:00:00') meaning
+    every response added or changed from then on, or a response pk meaning
+    the responses that came in after it.  Returns a (modified, pk) pair,
+    with None for modified in the last case, or None for no cursor at all.
+    Raises ValueError for anything else.
+    """
+    if not since:
+        return None
+    if since.isdigit():
+        return None, int(since)
+    if '_' in since:
+        stamp, pk = since.split('_', 1)
+        return datetime.datetime.strptime(stamp, CURSOR_FORMAT), int(pk)
+    for format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(since, format), 0
+        except ValueError:
+            pass
+    raise ValueError("Invalid cursor [%s]" % since)
+
+
+def changed_responses(poll, since=None, limit=None):
+    """
+    Returns the responses of ``poll`` added or recategorized since the
+    ``since`` cursor (see parse_cursor), as response dicts like those of
+    iter_response_chunks, at most ``limit`` of them, along with the cursor
+    to pass next time.  They come in (modified, pk) order, or in pk order
+    for a pk cursor, whose next cursor is a pk again and which only returns
+    new responses.  Responses changed in the last POLL_EXPORT_CURSOR_LAG
+    seconds are left for a later call.  Deleted responses aren't reported.
+    """
+    cursor = parse_cursor(since)
+    limit = limit or getattr(settings, 'POLL_EXPORT_PAGE_SIZE', 5000)
+    # modified (and the pk) are stamped before the writing transaction
+    # commits, so rows may show up later with older values than some already
+    # visible; nothing younger than the lag is handed out, so the cursor
+    # never moves past a transaction still in flight
+    horizon = datetime.datetime.now() - datetime.timedelta(seconds=getattr(settings, 'POLL_EXPORT_CURSOR_LAG', 300))
+    responses = poll.responses.all()
+    by_pk = cursor is not None and cursor[0] is None
+    if by_pk:
+        responses = responses.filter(pk__gt=cursor[1]).order_by('pk')
+    else:
+        if cursor is not None:
+            responses = responses.filter(Q(modified__gt=cursor[0]) | Q(modified=cursor[0], pk__gt=cursor[1]))
+        responses = responses.filter(modified__lte=horizon).order_by('modified', 'pk')
+    page = list(responses.values_list(*RESPONSE_COLUMNS)[:limit])
+    if by_pk:
+        # stop short of the first response too young to be sure of
+        for i, row in enumerate(page):
+            if row[1] > horizon:
+                page = page[:i]
+                break
+    if not page:
+        return [], since or ''
+
+    chunk_size = getattr(settings, 'POLL_EXPORT_CHUNK_SIZE', 500)
+    rows = []
+    for i in range(0, len(page), chunk_size):
+        rows.extend(_load_chunk(poll, page[i:i + chunk_size]))
+    last = rows[-1]
+    if by_pk:
+        return rows, str(last['id'])
+    return rows, '%s_%d' % (last['modified'].strftime(CURSOR_FORMAT), last['id'])
+
+
+def changed_responses_csv(poll, rows):
+    """
+    The CSV of the responses returned by changed_responses: the columns of
+    responses_as_csv between the response id and when it last changed.
+    """
+    buffer = cStringIO.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['id', 'sender', 'time', 'value', 'categories', 'modified'])
+    for row, columns in _csv_columns(poll, rows):
+        writer.writerow([row['id']] + columns + [row['modified'].strftime('%Y-%m-%dT%H:%M:%S')])
+    return buffer.getvalue()
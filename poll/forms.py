@@ -2,6 +2,7 @@ from django import forms
 
 from django.contrib.auth.models import Group
 from .models import Poll, Category, Rule ,Translation
+from .rule_guard import is_fast_enough
 from rapidsms.models import Contact
 from django.forms.widgets import RadioSelect
 
@@ -117,6 +118,13 @@ class RuleForm(forms.ModelForm):
         model = Rule
         fields = ('rule_type', 'rule_string')
 
+    def __init__(self, *args, **kwargs):
+        # the poll whose responses the rule is tried against for speed, and
+        # the contains_all_of/contains_one_of mode the rule will be run in
+        self.poll = kwargs.pop('poll', None)
+        self.rule_mode = kwargs.pop('rule_mode', None)
+        super(RuleForm, self).__init__(*args, **kwargs)
+
     def clean(self):
         cleaned_data = self.cleaned_data
         rule_string = cleaned_data.get('rule_string')
@@ -128,6 +136,16 @@ class RuleForm(forms.ModelForm):
                 self._errors['rule_string'] = self.error_class([u"You must provide a valid regular expression"])
                 del cleaned_data['rule_string']
 
+        if 'rule_string' in cleaned_data:
+            # the regex the rule will actually run, as Rule.save() builds it
+            rule = Rule(rule_type=rule_type, rule_string=rule_string, rule=self.rule_mode or self.instance.rule)
+            rule.update_regex()
+            regex = rule.get_regex() if rule.rule else rule.regex
+            sample_texts = self.poll.get_sample_texts() if self.poll else []
+            if regex and not is_fast_enough(regex, sample_texts):
+                self._errors['rule_string'] = self.error_class([u"This rule takes too long to evaluate, please simplify it"])
+                del cleaned_data['rule_string']
+
         # Always return the full collection of cleaned data.
         return cleaned_data
 
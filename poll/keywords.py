@@ -0,0 +1,142 @@
+import re
+from collections import deque
+
+# keywords the automaton takes over from the regexes: lowercase ascii words,
+# possibly several separated by spaces or apostrophes, whose regex match is
+# the same with or without re.IGNORECASE and re.UNICODE
+KEYWORD = re.compile(r"^[a-z0-9](?:[a-z0-9 ']*[a-z0-9])?$")
+
+STARTSWITH = 'sw'
+CONTAINS = 'c'
+ONE_OF = 'one'
+ALL_OF = 'all'
+
+# what \s, [a-zA-Z] and \w stand for in the rule regexes
+SPACE = ' \t\n\r\f\v'
+LETTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+WORD = LETTERS + '0123456789_'
+
+
+def _unescape(text):
+    return re.sub(r'\\(.)', r'\1', text)
+
+
+def _render(rule_type=None, rule=None, rule_string=''):
+    from .models import Rule
+    r = Rule(rule_type=rule_type, rule=rule, rule_string=rule_string)
+    if rule:
+        return r.get_regex()
+    r.update_regex()
+    return r.regex
+
+
+def parse_keyword_rule(regex):
+    """
+    Recognizes the regexes built by the Starts With and Contains rule types
+    and by Rule.get_regex (contains_all_of, contains_one_of) from plain
+    keywords, returning (kind, keywords), or None for any other regex.  A
+    parse only counts if rendering the keywords again gives back exactly
+    ``regex``.
+    """
+    from .models import Rule
+    candidates = []
+    for rule_type in (Rule.TYPE_STARTSWITH, Rule.TYPE_CONTAINS):
+        prefix, suffix = _render(rule_type=rule_type, rule_string='%s').split('%s')
+        if regex.startswith(prefix) and regex.endswith(suffix) and len(regex) > len(prefix) + len(suffix):
+            keywords = regex[len(prefix):len(regex) - len(suffix)].split('|')
+            candidates.append((rule_type, keywords, _render(rule_type=rule_type, rule_string='|'.join(keywords))))
+    all_of = re.findall(r'\(\?=\.\*\\b((?:\\.|[^\\])*?)\\b\)', regex)
+    if all_of:
+        keywords = [_unescape(k) for k in all_of]
+        candidates.append((ALL_OF, keywords, _render(rule=Rule.contains_all_of, rule_string=','.join(keywords))))
+    one_of = re.findall(r'\(\\b((?:\\.|[^\\])*?)\\b\)', regex)
+    if one_of:
+        keywords = [_unescape(k) for k in one_of]
+        candidates.append((ONE_OF, keywords, _render(rule=Rule.contains_one_of, rule_string=','.join(keywords))))
+
+    for kind, keywords, rendered in candidates:
+        if rendered != regex:
+            continue
+        keywords = [k.lower() for k in keywords]
+        if not all(KEYWORD.match(k) for k in keywords):
+            continue
+        return {Rule.TYPE_STARTSWITH: STARTSWITH, Rule.TYPE_CONTAINS: CONTAINS}.get(kind, kind), keywords
+    return None
+
+
+class KeywordAutomaton(object):
+    """
+    An Aho-Corasick automaton finding every occurrence of a set of keywords
+    in a single pass over a text, however many keywords there are.
+    """
+
+    def __init__(self, keywords):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                if char not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                    self.transitions[state][char] = len(self.transitions) - 1
+                state = self.transitions[state][char]
+            if keyword not in self.outputs[state]:
+                self.outputs[state].append(keyword)
+
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.transitions[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.transitions[fail].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def find(self, text):
+        """
+        Yields (start, keyword) for every occurrence of a keyword in ``text``.
+        """
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(char, 0)
+            for keyword in self.outputs[state]:
+                yield i - len(keyword) + 1, keyword
+
+
+class KeywordHits(object):
+    """
+    The keyword occurrences in one lower-cased, single line text, telling
+    for each keyword rule whether its regex would have matched.
+    """
+
+    def __init__(self, automaton, text):
+        self.starts = set()
+        self.ends = set()
+        self.words = set()
+        lead = len(text) - len(text.lstrip(SPACE))
+        for start, keyword in automaton.find(text):
+            end = start + len(keyword)
+            # followed by a non letter or the end, like (\s|[^a-zA-Z]|$)
+            if end == len(text) or text[end] not in LETTERS:
+                self.ends.add(keyword)
+                if start == lead:
+                    self.starts.add(keyword)
+            # surrounded by \b
+            if (start == 0 or text[start - 1] not in WORD) and (end == len(text) or text[end] not in WORD):
+                self.words.add(keyword)
+
+    def matches(self, kind, keywords):
+        if kind == STARTSWITH:
+            return any(k in self.starts for k in keywords)
+        elif kind == CONTAINS:
+            return any(k in self.ends for k in keywords)
+        elif kind == ONE_OF:
+            return any(k in self.words for k in keywords)
+        return all(k in self.words for k in keywords)
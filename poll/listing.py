@@ -0,0 +1,88 @@
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.query import prefetch_related_objects
+from django.contrib.contenttypes.models import ContentType
+from eav.models import Value
+from rapidsms.contrib.locations.models import Location
+from rapidsms_httprouter.models import Message
+
+from .models import Poll, Response
+from .export import VALUE_COLUMNS, CURSOR_FORMAT
+
+
+def parse_page_cursor(before):
+    """
+    Reads the ``before`` cursor of a response listing page, as handed out by
+    response_page: the (date, pk) of the last response of the previous
+    page.  Returns None for no cursor and raises ValueError for anything
+    else.
+    """
+    if not before:
+        return None
+    try:
+        stamp, pk = before.split('_', 1)
+        return datetime.datetime.strptime(stamp, CURSOR_FORMAT), int(pk)
+    except ValueError:
+        raise ValueError("Invalid cursor [%s]" % before)
+
+
+def response_page(poll, before=None, page_size=None):
+    """
+    Returns a page of the responses of ``poll``, newest first, starting
+    after the ``before`` cursor (see parse_page_cursor), along with the
+    cursor of the next page, or None on the last page.  Pages are read by
+    keyset on (date, pk) rather than by offset, so a page deep into a big
+    poll costs the same as the first one, and the responses come with
+    everything the response rows show (see prefetch_responses).
+    """
+    cursor = parse_page_cursor(before)
+    page_size = page_size or getattr(settings, 'POLL_RESPONSES_PAGE_SIZE', 50)
+    responses = poll.responses.all()
+    if cursor is not None:
+        responses = responses.filter(Q(date__lt=cursor[0]) | Q(date=cursor[0], pk__lt=cursor[1]))
+    responses = list(responses.order_by('-date', '-pk')[:page_size + 1])
+    next_cursor = None
+    if len(responses) > page_size:
+        responses = responses[:page_size]
+        last = responses[-1]
+        next_cursor = '%s_%d' % (last.date.strftime(CURSOR_FORMAT), last.pk)
+    prefetch_responses(poll, responses)
+    return responses, next_cursor
+
+
+def prefetch_responses(poll, responses):
+    """
+    Loads the message (with its connection, contact and the contact's
+    reporting location), value, categories and poll of every response in
+    ``responses`` (a list of responses of ``poll``) for a fixed number of
+    queries, so rendering them doesn't go back to the database for each
+    one.
+    """
+    if not responses:
+        return
+    by_pk = dict([(response.pk, response) for response in responses])
+    messages = Message.objects.select_related('connection__contact__reporting_location')\
+        .in_bulk(set([response.message_id for response in responses if response.message_id]))
+    for response in responses:
+        response.poll = poll
+        response.message = messages.get(response.message_id)
+
+    # fills the cache response.categories.all() reads from
+    prefetch_related_objects(responses, ['categories__category'])
+
+    db_type = Poll.TYPE_CHOICES[poll.type]['db_type']
+    if db_type not in VALUE_COLUMNS:
+        return
+    slug, column = VALUE_COLUMNS[db_type]
+    values = dict(Value.objects.filter(entity_ct=ContentType.objects.get_for_model(Response),
+                                       attribute__slug=slug, entity_id__in=by_pk.keys())
+                  .values_list('entity_id', column))
+    if column == 'generic_value_id':
+        locations = Location.objects.in_bulk(set([pk for pk in values.values() if pk]))
+        values = dict([(pk, locations.get(location_id)) for pk, location_id in values.items()])
+    for pk, response in by_pk.items():
+        # set on the entity as the poll's handlers do, so response.eav.<slug>
+        # doesn't look the value up again
+        setattr(response.eav, slug, values.get(pk))
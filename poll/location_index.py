@@ -0,0 +1,96 @@
+import difflib
+
+from django.db.models.signals import post_save, post_delete
+from rapidsms.contrib.locations.models import Location
+
+from django.conf import settings
+
+from .utils import VersionedCache
+
+# without a shared cache backend a process only notices new or renamed
+# locations once its index is this old, rather than rebuilding it for
+# every message
+_indexes = VersionedCache('location-index',
+                          local_timeout=getattr(settings, 'POLL_LOCATION_INDEX_TIMEOUT', 300))
+
+
+class LocationIndex(object):
+    """
+    Lower-cased location names indexed by their character bigrams.  match()
+    scores candidates like difflib.get_close_matches over every location
+    name (same ratio, cutoff and tie-breaking), but only considers the names
+    sharing at least one bigram with the text instead of the whole table.
+    Its results are equivalent except for the rare typos whose closest name
+    shares no bigram with them, which difflib can still find: that takes
+    every matching block being a single scattered letter, as when the
+    text's letters are scrambled.
+    """
+
+    def __init__(self, locations, cutoff=0.6):
+        """
+        ``locations`` is an iterable of (pk, name) pairs; when several
+        locations share a name the first one wins.
+        """
+        self.cutoff = cutoff
+        self.names = {}
+        self.bigrams = {}
+        for pk, name in locations:
+            name = name.lower()
+            if name in self.names:
+                continue
+            self.names[name] = pk
+            for bigram in self._bigrams(name):
+                self.bigrams.setdefault(bigram, []).append(name)
+
+    def _bigrams(self, name):
+        # the start and end markers let single letter names be matched too
+        padded = u'^%s$' % name
+        return set([padded[i:i + 2] for i in range(len(padded) - 1)])
+
+    def match(self, text):
+        """
+        Returns the pk of the location whose name is closest to ``text``, or
+        None if no name is close enough.
+        """
+        text = text.lower()
+        if text in self.names:
+            return self.names[text]
+
+        candidates = set()
+        for bigram in self._bigrams(text):
+            candidates.update(self.bigrams.get(bigram, ()))
+
+        best = None
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(text)
+        for name in candidates:
+            matcher.set_seq1(name)
+            if matcher.real_quick_ratio() >= self.cutoff and \
+               matcher.quick_ratio() >= self.cutoff:
+                score = matcher.ratio()
+                if score >= self.cutoff and (best is None or (score, name) > best):
+                    best = (score, name)
+        if best is None:
+            return None
+        return self.names[best[1]]
+
+
+def get_location_index():
+    """
+    Returns the index of all location names, built once per process and
+    rebuilt after any location is saved or deleted (or, without a shared
+    cache backend, once it is POLL_LOCATION_INDEX_TIMEOUT seconds old).
+    """
+    index = _indexes.get('locations')
+    if index is None:
+        index = LocationIndex(Location.objects.order_by('pk').values_list('pk', 'name'))
+        _indexes.set('locations', index)
+    return index
+
+
+def invalidate_location_index(sender, **kwargs):
+    _indexes.invalidate()
+
+
+post_save.connect(invalidate_location_index, sender=Location)
+post_delete.connect(invalidate_location_index, sender=Location)
@@ -0,0 +1,31 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+
+from poll.models import Poll
+from poll.columnar import write_npy_directory
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+
+    help = "Writes the responses of a poll as one .npy file per column, ready for memory-mapped reads"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        make_option('-d', '--directory', dest='d'),
+        make_option('-c', '--chunk_size', dest='c'),
+        )
+
+    def handle(self, **options):
+        if not options['p'] or not options['d']:
+            raise CommandError("Both --poll and --directory are needed")
+        try:
+            poll = Poll.objects.get(pk=int(options['p']))
+        except Poll.DoesNotExist:
+            raise CommandError("No poll with id %s" % options['p'])
+        chunk_size = int(options['c']) if options['c'] else None
+        for path in write_npy_directory(poll, options['d'], chunk_size):
+            self.stdout.write("%s\n" % path)
@@ -0,0 +1,25 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+
+from poll.models import Poll, ResponseCount
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+
+    help = "Recomputes the materialized response counts of a poll, or of every poll"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        )
+
+    def handle(self, **options):
+        polls = Poll.objects.order_by('pk')
+        if options['p']:
+            polls = polls.filter(pk=int(options['p']))
+        for poll in polls:
+            ResponseCount.objects.rebuild(poll)
+            self.stdout.write("rebuilt the counts of poll %d\n" % poll.pk)
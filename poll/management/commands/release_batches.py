@@ -0,0 +1,26 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+
+from poll.models import Poll
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+
+    help = "Queues the held per-backend batches of a poll that the backends can take now"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        )
+
+    def handle(self, **options):
+        poll_pk = int(options['p'])
+        try:
+            poll = Poll.objects.get(pk=poll_pk)
+            remaining = poll.release_batches()
+            self.stdout.write("%d batches still held\n" % remaining)
+        except Poll.DoesNotExist:
+            pass
@@ -12,13 +12,27 @@ class Command(BaseCommand):
 
     option_list = BaseCommand.option_list + (
         make_option('-p', '--poll', dest='p'),
+        make_option('-c', '--chunk_size', dest='c', default=None,
+                    help='create the outgoing messages this many recipients at a time'),
+        make_option('-r', '--resume', dest='r', action='store_true', default=False,
+                    help='finish a start that was interrupted'),
+        make_option('-l', '--parallel', dest='l', default=None,
+                    help='start from this many celery tasks, each messaging a range of the recipients'),
         )
 
     def handle(self, **options):
         poll_pk = int(options['p'])
         try:
             poll=Poll.objects.get(pk=poll_pk)
-            poll.start()
+            chunk_size = options['c'] and int(options['c'])
+            if options['r']:
+                poll.resume_start(chunk_size=chunk_size)
+            elif options['l']:
+                poll.start_parallel(partitions=int(options['l']), chunk_size=chunk_size)
+            elif chunk_size:
+                poll.start_streaming(chunk_size=chunk_size)
+            else:
+                poll.start()
         except Poll.DoesNotExist:
             pass
 
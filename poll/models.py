@@ -2,16 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import datetime
-import difflib
+import gzip
+import hashlib
+import os
+import tempfile
+import time
 from celery.task import task
 import django
-from django.db import models, transaction
-from django.db.models import Sum, Avg, Count, Max, Min, StdDev
+from django.db import models, transaction, connection
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.db.models import Sum, Avg, Count, Max, Min, StdDev, Q, F
 from django.contrib.sites.models import Site
 from django.contrib.sites.managers import CurrentSiteManager
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
 from django import forms
 from django.utils.translation import ugettext as _
 from mptt.forms import TreeNodeChoiceField
@@ -27,11 +34,18 @@ from rapidsms.contrib.locations.nested import models as nested_models
 #from rapidsms_httprouter.models import Message, MessageBatch
 #from rapidsms.router.db.models import Message
 
-from rapidsms_httprouter.models import Message
+from rapidsms_httprouter.models import Message, MessageBatch
 from django.conf import settings
 import re
-from django.utils.translation import (ugettext, activate, deactivate)
+from django.utils.translation import ugettext, trans_real
+from django.utils import simplejson
 from dateutil.relativedelta import relativedelta
+from .utils import VersionedCache, cache_is_shared, execute_sql, try_insert, bulk_create, BULK_BATCH_SIZE, supports_insert_select
+from .categorizer import Categorizer
+from .rule_guard import is_fast_enough_cached
+from .location_index import get_location_index
+from .rollups import category_totals
+from .report_cache import invalidate_poll_reports
 
 import logging
 
@@ -47,6 +61,9 @@ STARTSWITH_PATTERN_TEMPLATE = '^\s*(%s)(\s|[^a-zA-Z]|$)'
 
 CONTAINS_PATTERN_TEMPLATE = '^.*\s*(%s)(\s|[^a-zA-Z]|$)'
 
+# location responses are matched on their first word
+LOCATION_REGEX = re.compile(STARTSWITH_PATTERN_TEMPLATE % '[a-zA-Z]*', re.IGNORECASE)
+
 # This can be configurable from settings, but here's a default list of 
 # accepted yes keywords
 YES_WORDS = ['yes', 'yeah', 'yep', 'yay', 'y']
@@ -56,6 +73,12 @@ YES_WORDS = ['yes', 'yeah', 'yep', 'yay', 'y']
 
 NO_WORDS = ['no', 'nope', 'nah', 'nay', 'n']
 
+# poll pk -> Categorizer, dropped whenever a Category or Rule changes
+_categorizers = VersionedCache('categorizers')
+
+# language -> {md5 of a Translation's field: its value}
+_translations = VersionedCache('translations')
+
 
 class ResponseForm(forms.Form):
     def __init__(self, data=None, **kwargs):
@@ -183,6 +206,9 @@ class Poll(models.Model):
     on_site = CurrentSiteManager('sites')
     response_type = models.CharField(max_length=1, choices=RESPONSE_TYPE_CHOICES, default=RESPONSE_TYPE_ALL, null=True,
                                      blank=True)
+    # whether ResponseCount holds this poll's counts; polls that had responses
+    # before it existed need a rebuild_response_counts first
+    counts_materialized = models.BooleanField(default=True)
 
     class Meta:
         permissions = (
@@ -242,9 +268,9 @@ class Poll(models.Model):
             app_label, model_name = settings.BLACKLIST_MODEL.rsplit(".")
             try:
                 blacklists = models.get_model(app_label, model_name)._default_manager.values_list('connection')
-                contactsBefore = len(contacts)
+                contactsBefore = contacts.count()
                 contacts = contacts.exclude(connection__pk__in=blacklists)
-                contactsAfter = len(contacts)
+                contactsAfter = contacts.count()
                 log.info("[Poll.create_with_bulk] excluded [%d] blacklisted contacts. This poll will have [%d] active contacts." % ((contactsBefore - contactsAfter), contactsAfter))
             except:
                 raise Exception("Your Blacklist Model is Improperly configured")
@@ -254,7 +280,9 @@ class Poll(models.Model):
                                    user=user)
         #batch for responses
         log.info("[Poll.create_with_bulk] Adding contacts...")
-        poll.contacts.add(*contacts.values_list('pk', flat=True))
+        added = poll.add_contacts(contacts)
+        log.info("[Poll.create_with_bulk] added [%d] contacts ok." % added)
+        ActivePoll.objects.contacts_changed(poll)
 
         log.info("[Poll.create_with_bulk] Create message batch...")
         from rapidsms_httprouter.models import MessageBatch
@@ -268,6 +296,38 @@ class Poll(models.Model):
         log.info("[Poll.create_with_bulk] TRANSACTION COMMIT")
         return poll
 
+    def add_contacts(self, contacts):
+        """
+        Adds every contact of the ``contacts`` queryset to this poll without
+        loading them: a single INSERT ... SELECT on the backends that support
+        it, otherwise bulk inserts of their pks a chunk at a time.  Contacts
+        already in the poll are skipped.  Returns how many were added.
+        """
+        through = Poll.contacts.through
+        poll_column = through._meta.get_field('poll').column
+        contact_column = through._meta.get_field('contact').column
+        contact_ids = contacts.exclude(polls=self).order_by().values_list('pk', flat=True).distinct()
+
+        if supports_insert_select():
+            try:
+                select, params = contact_ids.query.sql_with_params()
+            except EmptyResultSet:
+                return 0
+            return execute_sql('INSERT INTO %s (%s, %s) SELECT %%s, recipients.id FROM (%s) recipients' % (
+                connection.ops.quote_name(through._meta.db_table),
+                connection.ops.quote_name(poll_column),
+                connection.ops.quote_name(contact_column),
+                select), (self.pk,) + tuple(params))
+
+        added, last_pk = 0, 0
+        while True:
+            chunk = list(contact_ids.filter(pk__gt=last_pk).order_by('pk')[:BULK_BATCH_SIZE])
+            if not chunk:
+                return added
+            bulk_create(through, [through(poll_id=self.pk, contact_id=pk) for pk in chunk])
+            added += len(chunk)
+            last_pk = chunk[-1]
+
     def add_yesno_categories(self):
         """
         This creates a generic yes/no poll categories for a particular poll
@@ -317,23 +377,24 @@ class Poll(models.Model):
     def log_poll_message_debug(self, message):
         log.debug("[poll-" + str(self.pk) + "] " + message)
 
-    def is_ready_to_send(self):
-        batches = MessageBatch.objects.filter(name=self.get_outgoing_message_batch_name()).all()
-        ready = True;
-
-        for batch in batches:
-            if batch.status != "P":
-                ready = False
-                break
+    def get_outgoing_message_batches(self):
+        """
+        The batches holding this poll's questions, including the per-backend
+        ones (see send_question).
+        """
+        name = self.get_outgoing_message_batch_name()
+        return MessageBatch.objects.filter(Q(name=name) | Q(name__startswith=name + '-'))
 
-        return ready
+    def is_ready_to_send(self):
+        return not self.get_outgoing_message_batches().exclude(status="P").exists()
 
     def queue_message_batches_to_send(self):
-        batches = MessageBatch.objects.filter(name=self.get_outgoing_message_batch_name()).all()
-        self.log_poll_message_info("Queueing [%d] MessageBatches for sending." % len(batches))
-        for batch in batches:
-            batch.status="Q"
-            batch.save()
+        if getattr(settings, "FEATURE_BATCH_PER_BACKEND", False):
+            self.log_poll_message_info("Scheduling the release of MessageBatches for sending.")
+            release_message_batches.delay(self.pk)
+            return
+        queued = self.get_outgoing_message_batches().update(status="Q")
+        self.log_poll_message_info("Queued [%d] MessageBatches for sending." % queued)
 
     @transaction.commit_on_success
     def start(self):
@@ -352,6 +413,7 @@ class Poll(models.Model):
         self.start_date = datetime.datetime.now()
         self.save()
         self.log_poll_message_info(" Start date saved ok.")
+        ActivePoll.objects.poll_started(self)
 
         self.log_poll_message_info(" start - startDate=" + str(self.start_date))
 
@@ -367,46 +429,402 @@ class Poll(models.Model):
                 localized_contacts = contacts.filter(language=language)
             if localized_contacts.exists():
                 self.log_poll_message_info(" creating messages using Message.mass_text for [%d] contacts in [%s]..." % (len(localized_contacts), language))
-                messages = Message.mass_text(gettext_db(field=self.question, language=language),
-                                             Connection.objects.filter(contact__in=localized_contacts).distinct(),
-                                             status='Q', batch_status=self.get_start_poll_batch_status(),
-                                             batch_name=self.get_outgoing_message_batch_name())
-                #localized_messages[language] = [messages, localized_contacts]
-                self.log_poll_message_info(" messages created ok. Adding messages to self...")
-                self.messages.add(*messages.values_list('pk', flat=True))
-                self.log_poll_message_info(" messages added ok.")
-
+                self.send_question(gettext_db(field=self.question, language=language),
+                                   Connection.objects.filter(contact__in=localized_contacts).distinct(),
+                                   self.get_start_poll_batch_status())
+                self.log_poll_message_info(" messages created and added ok.")
+
+        # the release task can't see the batches until this transaction
+        # commits (it retries until it can), so give it one interval's head
+        # start
+        self.schedule_batch_release(countdown=getattr(settings, 'POLL_RELEASE_INTERVAL', 60))
         self.log_poll_message_info(" sending poll_started signal...")
         poll_started.send(sender=self)
         self.log_poll_message_info(" poll_started signal sent ok.")
         self.log_poll_message_info(" TRANSACTION COMMIT")
 
+    def start_streaming(self, chunk_size=None):
+        """
+        Starts the poll like start() does, but creates the outgoing messages
+        ``chunk_size`` recipients at a time, each chunk in its own transaction,
+        so that starting a poll with a million recipients neither holds locks
+        for the whole run nor loads every recipient into memory.  Each chunk
+        commits together with a checkpoint in the poll's StartProgress, so a
+        start that dies half way can be finished with resume_start().
+        """
+        with transaction.commit_on_success():
+            if not self._begin_start():
+                return
+            progress = StartProgress.objects.create(poll=self, recipients=self.get_recipients().count())
+        self._finish_start(progress, chunk_size)
+
+    def start_parallel(self, partitions=None, chunk_size=None):
+        """
+        Starts the poll by splitting the recipients into ``partitions`` ranges
+        of connection pks and streaming each range from its own celery task.
+        The messages are held in prepared batches until the last partition
+        completes, which then releases them and sends poll_started.
+        """
+        partitions = partitions or getattr(settings, 'POLL_START_PARTITIONS', 4)
+        with transaction.commit_on_success():
+            progresses = self._start_partitions(partitions)
+        self.log_poll_message_info(" dispatching [%d] start partitions..." % len(progresses))
+        for progress in progresses:
+            start_poll_partition.delay(progress.pk, chunk_size)
+
+    def _start_partitions(self, partitions):
+        if not self._begin_start():
+            return []
+        recipients = self.get_recipients().order_by('pk').values_list('pk', flat=True)
+        total = recipients.count()
+        size = max(1, -(-total // partitions))
+        progresses = []
+        lower = 0
+        for end in range(size, total + size, size):
+            upper = recipients[min(end, total) - 1]
+            progresses.append(StartProgress.objects.create(poll=self, recipients=min(end, total) - (end - size),
+                                                           last_connection=lower, upper=upper))
+            lower = upper
+        if not progresses:
+            # nobody to message, a single empty partition still completes the start
+            progresses.append(StartProgress.objects.create(poll=self, upper=0))
+        return progresses
+
+    def _begin_start(self):
+        if self.start_date:
+            if self.get_incomplete_start():
+                self.log_poll_message_warn(" poll start was interrupted, use resume_start to finish it!")
+            else:
+                self.log_poll_message_warn(" poll has a start date, not starting poll!")
+            return False
+        self.start_date = datetime.datetime.now()
+        self.save()
+        ActivePoll.objects.poll_started(self)
+        return True
+
+    def resume_start(self, chunk_size=None):
+        """
+        Carries on an interrupted start_streaming() or start_parallel() from
+        the last committed chunk of each unfinished partition; recipients in
+        earlier chunks are not messaged again.
+        """
+        incomplete = list(self.start_progress.filter(completed=None).order_by('pk'))
+        if not incomplete:
+            self.log_poll_message_warn(" no interrupted start to resume!")
+            return
+        for progress in incomplete:
+            self.log_poll_message_info(" resuming start after connection [%d]..." % progress.last_connection)
+            self._finish_start(progress, chunk_size)
+
+    def get_incomplete_start(self):
+        try:
+            return self.start_progress.filter(completed=None).latest('pk')
+        except StartProgress.DoesNotExist:
+            return None
+
+    def _finish_start(self, progress, chunk_size):
+        chunk_size = chunk_size or getattr(settings, 'POLL_START_CHUNK_SIZE', 5000)
+        self.log_poll_message_info(" streaming start to [%d] recipients in chunks of [%d]..." % (progress.recipients, chunk_size))
+        if self._send_start_chunks(progress, chunk_size) and self._complete_start(progress):
+            self.schedule_batch_release()
+            self.log_poll_message_info(" sending poll_started signal...")
+            poll_started.send(sender=self)
+
+    @transaction.commit_on_success
+    def _complete_start(self, progress):
+        """
+        Marks ``progress`` complete, returning True if it was the last
+        unfinished part of the start.
+        """
+        # serializes partitions finishing at the same time, so exactly one of
+        # them sees no other partition left
+        Poll.objects.select_for_update().get(pk=self.pk)
+        if not StartProgress.objects.filter(pk=progress.pk, completed=None).update(completed=datetime.datetime.now()):
+            return False
+        if self.start_progress.filter(completed=None).exists():
+            return False
+        if progress.upper is not None and self.get_start_poll_batch_status() != 'P':
+            self.log_poll_message_info(" all start partitions complete, releasing batches...")
+            MessageBatch.objects.filter(name=self.get_outgoing_message_batch_name(), status='P')\
+                .update(status=self.get_start_poll_batch_status())
+        return True
+
+    def get_recipients(self):
+        """
+        The connections the question of this poll is sent to.
+        """
+        return Connection.objects.filter(contact__polls=self)
+
+    def _localized_questions(self):
+        """
+        The question in each language, keyed by contact language; contacts with
+        no language preference get the default language.
+        """
+        questions = {}
+        for language in dict(settings.LANGUAGES).keys():
+            questions[language] = gettext_db(field=self.question, language=language)
+        if settings.DEFAULT_LANGUAGE in questions:
+            questions[''] = questions[settings.DEFAULT_LANGUAGE]
+        return questions
+
+    def _send_start_chunks(self, progress, chunk_size):
+        """
+        Sends the question to the recipients after the progress checkpoint,
+        one chunk per transaction.  Returns False if another process moved
+        the checkpoint underneath us, in which case that process finishes.
+        """
+        questions = self._localized_questions()
+        recipients = self.get_recipients().order_by('pk').values_list('pk', 'contact__language')
+        if progress.upper is None:
+            batch_status = self.get_start_poll_batch_status()
+        else:
+            # partitions of a parallel start hold their batches until all are done
+            recipients = recipients.filter(pk__lte=progress.upper)
+            batch_status = 'P'
+        last_pk = progress.last_connection
+        while True:
+            chunk = list(recipients.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                return True
+            first_pk, upper_pk = chunk[0][0], chunk[-1][0]
+
+            languages_by_question = {}
+            for pk, language in chunk:
+                if language in questions:
+                    languages_by_question.setdefault(questions[language], set()).add(language)
+
+            with transaction.commit_on_success():
+                checkpoint = StartProgress.objects.select_for_update().get(pk=progress.pk)
+                if checkpoint.last_connection != last_pk:
+                    self.log_poll_message_warn(" start checkpoint moved to [%d], stopping" % checkpoint.last_connection)
+                    return False
+                sent = 0
+                for question, languages in languages_by_question.items():
+                    connections = self.get_recipients().filter(pk__gte=first_pk, pk__lte=upper_pk,
+                                                               contact__language__in=languages)
+                    sent += self.send_question(question, connections, batch_status)
+                StartProgress.objects.filter(pk=progress.pk).update(sent=F('sent') + sent,
+                                                                    chunks=F('chunks') + 1,
+                                                                    last_connection=upper_pk)
+            last_pk = upper_pk
+            self.log_poll_message_debug(" sent chunk of [%d] messages up to connection [%d]" % (sent, last_pk))
+
+    def send_question(self, text, connections, batch_status):
+        """
+        Creates the outgoing ``text`` to every connection of ``connections``
+        in the poll's outgoing batch and returns how many messages were made.
+        With FEATURE_BATCH_PER_BACKEND the messages are instead split into
+        batches of at most POLL_BATCH_SIZE messages for a single backend,
+        named after the backend and their first connection, and held in
+        status P for release_batches() to queue at the backend's rate.
+        """
+        if not getattr(settings, "FEATURE_BATCH_PER_BACKEND", False):
+            messages = Message.mass_text(text, connections, status='Q', batch_status=batch_status,
+                                         batch_name=self.get_outgoing_message_batch_name())
+            return self._add_messages(messages)
+
+        size = getattr(settings, 'POLL_BATCH_SIZE', 5000)
+        sent = 0
+        for backend_id, backend_name in connections.order_by().values_list('backend', 'backend__name').distinct():
+            connection_ids = connections.filter(backend=backend_id).order_by('pk').values_list('pk', flat=True)
+            last_pk = 0
+            while True:
+                chunk = list(connection_ids.filter(pk__gt=last_pk)[:size])
+                if not chunk:
+                    break
+                messages = Message.mass_text(text, Connection.objects.filter(pk__in=chunk), status='Q',
+                                             batch_status='P',
+                                             batch_name=self.get_backend_batch_name(backend_name, chunk[0]))
+                sent += self._add_messages(messages)
+                last_pk = chunk[-1]
+        return sent
+
+    def get_backend_batch_name(self, backend_name, first_connection):
+        return "%s-%s-%d" % (self.get_outgoing_message_batch_name(), backend_name, first_connection)
+
+    def schedule_batch_release(self, countdown=None):
+        if getattr(settings, "FEATURE_BATCH_PER_BACKEND", False) and self.get_start_poll_batch_status() != "P":
+            release_message_batches.apply_async(args=[self.pk], countdown=countdown)
+
+    def release_batches(self):
+        """
+        Queues this poll's held per-backend batches, oldest first, as far as
+        each backend's rate allows.  POLL_BACKEND_RATES maps backend names to
+        messages per minute (POLL_DEFAULT_BACKEND_RATE for the others, None
+        meaning unlimited); a backend may receive one release interval's worth
+        of messages minus those it still has queued, and always at least one
+        batch once its queue is empty.  Returns the number of batches still
+        held.
+        """
+        rates = getattr(settings, 'POLL_BACKEND_RATES', {})
+        default_rate = getattr(settings, 'POLL_DEFAULT_BACKEND_RATE', None)
+        interval = getattr(settings, 'POLL_RELEASE_INTERVAL', 60)
+        prefix = self.get_outgoing_message_batch_name() + '-'
+
+        held = {}
+        for batch_id, name, size in Message.objects.filter(batch__name__startswith=prefix, batch__status='P')\
+                .values_list('batch', 'batch__name').annotate(Count('pk')).order_by('batch'):
+            backend_name = name[len(prefix):].rsplit('-', 1)[0]
+            held.setdefault(backend_name, []).append((batch_id, size))
+
+        queued = dict(Message.objects.filter(direction='O', status='Q', batch__status='Q',
+                                             connection__backend__name__in=held.keys())\
+                      .values_list('connection__backend__name').annotate(Count('pk')).order_by())
+
+        released = []
+        remaining = 0
+        for backend_name, batches in held.items():
+            rate = rates.get(backend_name, default_rate)
+            backlog = queued.get(backend_name, 0)
+            allowance = None if rate is None else rate * interval / 60 - backlog
+            for i, (batch_id, size) in enumerate(batches):
+                if allowance is not None and size > allowance and (backlog or i):
+                    remaining += len(batches) - i
+                    break
+                released.append(batch_id)
+                if allowance is not None:
+                    allowance -= size
+        if released:
+            MessageBatch.objects.filter(pk__in=released).update(status='Q')
+        self.log_poll_message_info(" released [%d] batches, [%d] still held" % (len(released), remaining))
+        return remaining
+
+    def _add_messages(self, messages):
+        through = Poll.messages.through
+        message_ids = list(messages.values_list('pk', flat=True))
+        bulk_create(through, [through(poll_id=self.pk, message_id=pk) for pk in message_ids])
+        return len(message_ids)
+
     def end(self):
         self.end_date = datetime.datetime.now()
         self.save()
+        ActivePoll.objects.poll_ended(self)
 
-    def reprocess_responses(self):
-        for rc in ResponseCategory.objects.filter(category__poll=self, is_override=False):
-            rc.delete()
-
-        for resp in self.responses.all():
-            resp.has_errors = False
-            for category in self.categories.all():
-                for rule in category.rules.all():
-                    regex = re.compile(rule.regex, re.IGNORECASE)
-                    if resp.eav.poll_text_value:
-                        if regex.search(resp.eav.poll_text_value.lower()) and not resp.categories.filter(
-                                category=category).count():
-                            if category.error_category:
-                                resp.has_errors = True
-                            rc = ResponseCategory.objects.create(response=resp, category=category)
-                            break
-            if not resp.categories.all().count() and self.categories.filter(default=True).count():
-                if self.categories.get(default=True).error_category:
-                    resp.has_errors = True
-                resp.categories.add(
-                    ResponseCategory.objects.create(response=resp, category=self.categories.get(default=True)))
-            resp.save()
+    def is_active(self):
+        """
+        A poll is active (i.e. incoming messages from its contacts may be
+        responses to it) once it has started and until its end date.
+        """
+        return self.start_date is not None and \
+               (self.end_date is None or self.end_date > datetime.datetime.now())
+
+    def get_categorizer(self):
+        """
+        Returns the compiled categories and rules of this poll, built once per
+        process and rebuilt after any of its categories or rules change (or
+        on every call without a shared cache backend, see VersionedCache).
+        """
+        categorizer = _categorizers.get(self.pk)
+        if categorizer is None:
+            categorizer = self.build_categorizer()
+            _categorizers.set(self.pk, categorizer)
+        return categorizer
+
+    def build_categorizer(self, exclude_rule=None, extra_rules=()):
+        """
+        Compiles the poll's categories and rules, leaving out the rule with pk
+        ``exclude_rule`` and adding the (category pk, regex) ``extra_rules``,
+        to try out rule changes before saving them.
+        """
+        rules = Rule.objects.filter(category__poll=self).order_by('pk')
+        if exclude_rule:
+            rules = rules.exclude(pk=exclude_rule)
+        checked = []
+        for category_id, regex, rule_type in rules.values_list('category', 'regex', 'rule_type'):
+            # regex rules saved before Rule.save() checked them could still
+            # block the router for as long as a runaway match takes
+            if rule_type == Rule.TYPE_REGEX and not is_fast_enough_cached(regex):
+                log.warn("[Poll.build_categorizer] ignoring rule [%s] of poll [%d], it takes too long to evaluate"
+                         % (regex, self.pk))
+                continue
+            checked.append((category_id, regex))
+        # POLL_CATEGORIZE_TIME_BUDGET is best-effort only, see Categorizer
+        return Categorizer(self.categories.all(), checked + list(extra_rules),
+                           time_budget=getattr(settings, 'POLL_CATEGORIZE_TIME_BUDGET', 0.5))
+
+    def get_sample_texts(self, count=200):
+        """
+        The texts of the latest ``count`` text responses to this poll.
+        """
+        oldest = list(self.responses.order_by('-pk').values_list('pk', flat=True)[count - 1:count])
+        texts = []
+        for chunk in self.iter_response_texts(from_pk=oldest[0] - 1 if oldest else 0):
+            texts.extend(text for pk, text in chunk if text)
+        return texts
+
+    def preview_rule(self, category, regex, replaces=None, sample=None, time_budget=None, examples=5):
+        """
+        Dry-runs ``regex`` as a rule of ``category`` (in place of the rule
+        with pk ``replaces`` when editing one) against the poll's text
+        responses, without writing anything.  Returns the number of responses
+        the category would newly match, would lose, and would share with
+        another category, with up to ``examples`` texts of each.  With
+        ``sample`` only the latest that many responses are looked at; with
+        ``time_budget`` the scan stops after that many seconds, ``complete``
+        telling whether every response was looked at.
+        """
+        before = self.get_categorizer()
+        after = self.build_categorizer(exclude_rule=replaces, extra_rules=[(category.pk, regex)])
+        from_pk = 0
+        if sample:
+            oldest = list(self.responses.order_by('-pk').values_list('pk', flat=True)[sample - 1:sample])
+            if oldest:
+                from_pk = oldest[0] - 1
+        deadline = time_budget and time.time() + time_budget
+
+        counts = {'matched': 0, 'lost': 0, 'conflicts': 0}
+        found = {'matched': [], 'lost': [], 'conflicts': []}
+        scanned = 0
+        complete = True
+        for chunk in self.iter_response_texts(from_pk=from_pk):
+            for pk, text in chunk:
+                if deadline and time.time() > deadline:
+                    complete = False
+                    break
+                scanned += 1
+                was_matched = category in before.categorize(text)
+                categories = after.categorize(text)
+                changes = []
+                if category in categories:
+                    if not was_matched:
+                        changes.append('matched')
+                    if len(categories) > 1:
+                        changes.append('conflicts')
+                elif was_matched:
+                    changes.append('lost')
+                for change in changes:
+                    counts[change] += 1
+                    if len(found[change]) < examples:
+                        found[change].append(text)
+            if not complete:
+                break
+        counts.update({'examples': found, 'scanned': scanned, 'complete': complete})
+        return counts
+
+    def reprocess_responses(self, progress=None):
+        """
+        Re-evaluates every response of the poll against the current rules.
+        Responses are classified in memory a chunk at a time, with their texts
+        read in one query per chunk, and only the ResponseCategory rows that
+        differ are written; override rows are kept.  ``progress`` is called
+        with the number of responses done after each chunk.
+        """
+        categorizer = self.get_categorizer()
+        chunk_size = getattr(settings, 'POLL_REPROCESS_CHUNK_SIZE', 500)
+        response_ids = self.responses.order_by('pk').values_list('pk', flat=True)
+        texts = Value.objects.filter(entity_ct=ContentType.objects.get_for_model(Response),
+                                     attribute__slug='poll_text_value')
+        last_pk = processed = 0
+        while True:
+            chunk = list(response_ids.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            chunk_texts = dict(texts.filter(entity_id__in=chunk).values_list('entity_id', 'value_text'))
+            self._recategorize_bulk([(pk, chunk_texts.get(pk)) for pk in chunk], categorizer)
+            last_pk = chunk[-1]
+            processed += len(chunk)
+            if progress:
+                progress(processed)
 
     def process_response(self, message):
         self.log_poll_message_debug("processing response...")
@@ -419,94 +837,177 @@ class Poll(models.Model):
                                        date=db_message.date)
 
         self.log_poll_message_debug("Response PK ={}".format(str(resp.pk)))
+        values, categories, has_errors, outgoing_message = self._parse_response(message.text,
+                                                                                self.get_categorizer())
+        for slug, value in values.items():
+            setattr(resp.eav, slug, value)
+        resp.has_errors = has_errors
+        for category in categories:
+            ResponseCategory.objects.create(response=resp, category=category)
+
+        self.log_poll_message_debug("Added categories [{}]".format(categories))
+        resp.save()
+        ResponseCount.objects.record(self, [(resp.pk, None, set(c.pk for c in categories))])
+        if not outgoing_message:
+            return (resp, None,)
+        else:
+            if db_message.connection.contact and db_message.connection.contact.language:
+                outgoing_message = gettext_db(language=db_message.connection.contact.language, field=outgoing_message)
+
+            return (resp, outgoing_message,)
+
+    @transaction.commit_on_success
+    def process_responses_bulk(self, messages):
+        """
+        Processes a batch of incoming messages the way process_response does
+        one at a time, but parses and categorizes them all in memory and then
+        writes the responses, their categories and values with a few bulk
+        inserts.  Messages are expected to come from this poll's contacts;
+        response_type is not enforced here.
+
+        Returns a list of (response, outgoing message) pairs, in the order of
+        ``messages``, with None in place of the outgoing message when nothing
+        should be sent back.
+        """
+        categorizer = self.get_categorizer()
+        parsed = []
+        for message in messages:
+            db_message = message.db_message if hasattr(message, 'db_message') else message
+            parsed.append((db_message,) + self._parse_response(message.text, categorizer))
+        if not parsed:
+            return []
+
+        connections = Connection.objects.in_bulk(set([p[0].connection_id for p in parsed]))
+        contact_ids = set([c.contact_id for c in connections.values() if c.contact_id])
+        languages = dict(Contact.objects.filter(pk__in=contact_ids).values_list('pk', 'language'))
+
+        responses = []
+        for db_message, values, categories, has_errors, outgoing_message in parsed:
+            contact_id = connections[db_message.connection_id].contact_id
+            responses.append(Response(poll=self, message=db_message, contact_id=contact_id,
+                                      date=db_message.date, has_errors=has_errors))
+        bulk_create(Response, responses)
+
+        # bulk inserts don't hand back primary keys; the newest responses of
+        # each message in this poll are the ones just created, in creation
+        # order (a message may come up more than once in a batch)
+        created = {}
+        for resp in responses:
+            created[resp.message_id] = created.get(resp.message_id, 0) + 1
+        message_ids = created.keys()
+        response_ids = {}
+        for i in range(0, len(message_ids), BULK_BATCH_SIZE):
+            for message_id, pk in Response.objects.filter(poll=self, message__in=message_ids[i:i + BULK_BATCH_SIZE])\
+                    .order_by('pk').values_list('message', 'pk'):
+                response_ids.setdefault(message_id, []).append(pk)
+        for message_id, count in created.items():
+            response_ids[message_id] = response_ids[message_id][-count:]
+        for resp in responses:
+            resp.pk = response_ids[resp.message_id].pop(0)
+
+        attributes = dict([(a.slug, a) for a in Attribute.objects.filter(
+            slug__in=['poll_text_value', 'poll_number_value', 'poll_location_value'])])
+        entity_ct = ContentType.objects.get_for_model(Response)
+        eav_values = []
+        response_categories = []
+        results = []
+        for resp, (db_message, values, categories, has_errors, outgoing_message) in zip(responses, parsed):
+            for slug, value in values.items():
+                if value is None:
+                    continue
+                eav_value = Value(entity_ct=entity_ct, entity_id=resp.pk, attribute=attributes[slug])
+                setattr(eav_value, 'value_%s' % attributes[slug].datatype, value)
+                eav_values.append(eav_value)
+            for category in categories:
+                response_categories.append(ResponseCategory(response_id=resp.pk, category=category))
+            language = languages.get(resp.contact_id)
+            if outgoing_message and language:
+                outgoing_message = gettext_db(language=language, field=outgoing_message)
+            results.append((resp, outgoing_message or None,))
+        bulk_create(Value, eav_values)
+        bulk_create(ResponseCategory, response_categories)
+        ResponseCount.objects.record(self, [(resp.pk, None, set(c.pk for c in p[2]))
+                                            for resp, p in zip(responses, parsed)])
+
+        self.log_poll_message_info("Processed [%d] responses in bulk." % len(results))
+        return results
+
+    def _parse_response(self, text, categorizer):
+        """
+        Works out what an incoming message with ``text`` means for this poll,
+        without writing anything.  Returns a tuple of (response values keyed
+        by eav attribute slug, categories, has_errors, outgoing message).
+        """
+        values = {}
+        categories = []
+        has_errors = False
         outgoing_message = self.default_response
         if (self.type == Poll.TYPE_LOCATION):
-            location_template = STARTSWITH_PATTERN_TEMPLATE % '[a-zA-Z]*'
-            regex = re.compile(location_template, re.IGNORECASE)
-            if regex.search(message.text):
-                spn = regex.search(message.text).span()
-                location_str = message.text[spn[0]:spn[1]]
-                area = None
-                area_names = Location.objects.all().values_list('name', flat=True)
-                area_names_lower = [ai.lower() for ai in area_names]
-                area_names_matches = difflib.get_close_matches(location_str.lower(), area_names_lower)
-                if area_names_matches:
-                    area = Location.objects.filter(name__iexact=area_names_matches[0])[0]
-                    resp.eav.poll_location_value = area
-                    resp.save()
+            match = LOCATION_REGEX.search(text)
+            if match:
+                location_str = text[match.start():match.end()]
+                location_pk = get_location_index().match(location_str)
+                if location_pk is not None:
+                    values['poll_location_value'] = Location.objects.get(pk=location_pk)
                 else:
-                    resp.has_errors = True
+                    has_errors = True
 
             else:
-                resp.has_errors = True
+                has_errors = True
 
         elif (self.type == Poll.TYPE_NUMERIC):
             try:
                 regex = re.compile(r"(-?\d+(\.\d+)?)")
                 #split the text on number regex. if the msg is of form
                 #'19'or '19 years' or '19years' or 'age19'or 'ugx34.56shs' it returns a list of length 4
-                msg_parts = regex.split(message.text)
+                msg_parts = regex.split(text)
                 if len(msg_parts) == 4:
-                    resp.eav.poll_number_value = float(msg_parts[1])
+                    values['poll_number_value'] = float(msg_parts[1])
                 else:
-                    resp.has_errors = True
+                    has_errors = True
             except IndexError:
-                resp.has_errors = True
+                has_errors = True
 
         elif ((self.type == Poll.TYPE_TEXT) or (self.type == Poll.TYPE_REGISTRATION)):
-            resp.eav.poll_text_value = message.text
-            if self.categories:
-                for category in self.categories.all():
-                    for rule in category.rules.all():
-                        regex = re.compile(rule.regex, re.IGNORECASE)
-                        if regex.search(message.text.lower()):
-                            rc = ResponseCategory.objects.create(response=resp, category=category)
-                            resp.categories.add(rc)
-                            if category.error_category:
-                                resp.has_errors = True
-                                outgoing_message = category.response
-                            break
+            values['poll_text_value'] = text
+            categories = categorizer.categorize(text)
+            for category in categories:
+                if category.error_category:
+                    has_errors = True
+                    outgoing_message = category.response
 
         elif self.type in Poll.TYPE_CHOICES:
             typedef = Poll.TYPE_CHOICES[self.type]
             try:
-                cleaned_value = typedef['parser'](message.text)
+                cleaned_value = typedef['parser'](text)
                 if typedef['db_type'] == Attribute.TYPE_TEXT:
-                    resp.eav.poll_text_value = cleaned_value
+                    values['poll_text_value'] = cleaned_value
                 elif typedef['db_type'] == Attribute.TYPE_FLOAT or \
                                 typedef['db_type'] == Attribute.TYPE_INT:
-                    resp.eav.poll_number_value = cleaned_value
+                    values['poll_number_value'] = cleaned_value
                 elif typedef['db_type'] == Attribute.TYPE_OBJECT:
-                    resp.eav.poll_location_value = cleaned_value
+                    values['poll_location_value'] = cleaned_value
             except ValidationError as e:
-                resp.has_errors = True
+                has_errors = True
                 if getattr(e, 'messages', None):
                     outgoing_message = str(e.messages[0])
                 else:
                     outgoing_message = None
 
-        self.log_poll_message_debug("checking for categorisation...")
-        if not resp.categories.all().count() and self.categories.filter(default=True).count():
-            resp.categories.add(ResponseCategory.objects.create(response=resp, category=self.categories.get(default=True)))
-            if self.categories.get(default=True).error_category:
-                resp.has_errors = True
-                outgoing_message = self.categories.get(default=True).response
-
-        if (not resp.has_errors or not outgoing_message):
-            for respcategory in resp.categories.order_by('category__priority'):
-                if respcategory.category.response:
-                    outgoing_message = respcategory.category.response
+        if not categories and categorizer.default:
+            categories = [categorizer.default]
+            if categorizer.default.error_category:
+                has_errors = True
+                outgoing_message = categorizer.default.response
+
+        if (not has_errors or not outgoing_message):
+            # categories without a priority come last, as postgres orders them
+            for category in sorted(categories, key=lambda c: (c.priority is None, c.priority)):
+                if category.response:
+                    outgoing_message = category.response
                     break
 
-        self.log_poll_message_debug("Added categories [{}]".format([r.category for r in resp.categories.all()]))
-        resp.save()
-        if not outgoing_message:
-            return (resp, None,)
-        else:
-            if db_message.connection.contact and db_message.connection.contact.language:
-                outgoing_message = gettext_db(language=db_message.connection.contact.language, field=outgoing_message)
-
-            return (resp, outgoing_message,)
+        return values, categories, has_errors, outgoing_message
 
     def get_start_poll_batch_status(self):
         if getattr(settings, "FEATURE_PREPARE_SEND_POLL", False):
@@ -552,6 +1053,8 @@ class Poll(models.Model):
         return q
 
     def responses_by_category(self, location=None, for_map=True):
+        if self.counts_materialized:
+            return self._counted_responses_by_category(location, for_map)
         categorized = ResponseCategory.objects.filter(response__poll=self)
         uncategorized = self.responses.exclude(
             pk__in=ResponseCategory.objects.filter(response__poll=self).values_list('response', flat=True))
@@ -652,33 +1155,109 @@ class Poll(models.Model):
 
         return categorized
     
+    def _counted_responses_by_category(self, location, for_map):
+        """
+        responses_by_category read from the materialized ResponseCount rows:
+        the same dicts, ordered by location and category name, with the
+        uncategorized ones last.
+        """
+        categories = self.categories.order_by('name')
+        if not location:
+            totals = self.category_totals()
+            results = [{'category__name': c.name, 'category__color': c.color, 'value': totals[(None, c.pk)]}
+                       for c in categories if totals.get((None, c.pk))]
+            if totals.get((None, None)):
+                results.append({'poll__pk': self.pk, 'value': totals[(None, None)],
+                                'category__name': 'uncategorized', 'category__color': ''})
+            return results
+
+        targets = list(location.get_children().select_related('point')) or [location]
+        if for_map:
+            targets = [target for target in targets if target.point_id]
+        totals = self.category_totals(targets)
+        categorized, uncategorized = [], []
+        for target in sorted(targets, key=lambda l: l.name):
+            row = {'location_name': target.name, 'location_id': target.pk}
+            if for_map:
+                row['lat'] = '%.5f' % float(target.point.latitude)
+                row['lon'] = '%.5f' % float(target.point.longitude)
+            for c in categories:
+                if totals.get((target.pk, c.pk)):
+                    categorized.append(dict(row, category__name=c.name, category__color=c.color,
+                                            value=totals[(target.pk, c.pk)]))
+            if totals.get((target.pk, None)):
+                uncategorized.append(dict(row, category__name='uncategorized', category__color='',
+                                          value=totals[(target.pk, None)]))
+        return categorized + uncategorized
+
+    def category_report_rows(self, roots, categories=None):
+        """
+        The rows of the category report of ``roots``: one per child of each
+        root (or per root without children) that has responses, ordered by
+        root then by name, with report_data holding a (category name, color,
+        count, percentage) tuple per category in name order plus one for the
+        uncategorized responses.  Costs the same few queries however many
+        locations there are.
+        """
+        roots = list(roots)
+        if categories is None:
+            categories = list(self.categories.order_by('name'))
+        children = {}
+        for child in Location.objects.filter(tree_parent__in=[root.pk for root in roots]).order_by('name'):
+            children.setdefault(child.tree_parent_id, []).append(child)
+        targets = []
+        for root in roots:
+            targets.extend(children.get(root.pk, [root]))
+        totals = self.category_totals(targets)
+
+        rows = []
+        for target in targets:
+            counts = [totals.get((target.pk, c.pk), 0) for c in categories]
+            uncategorized = totals.get((target.pk, None), 0)
+            total = float(sum(counts) + uncategorized)
+            if not total:
+                continue
+            data = [(c.name, c.color, n) for c, n in zip(categories, counts)] + [('uncategorized', '', uncategorized)]
+            rows.append({
+                'location_name': target.name,
+                'location_id': target.pk,
+                'report_data': [d + (d[2] * 100.0 / total,) for d in data],
+            })
+        return rows
+
     def simple_responses_by_category(self, location=None):
-    
-        categorized = ResponseCategory.objects.filter(response__poll=self)
-        uncategorized = self.responses.exclude(
-            pk__in=ResponseCategory.objects.filter(response__poll=self).values_list('response', flat=True))
-        
+        """
+        Returns {location: {category name: count, 'uncategorized': count,
+        'total': count}} for each child of ``location``, each child counting
+        the responses from its whole subtree, all from a single grouped
+        query.  Without a location the counts of the whole poll are keyed by
+        None.
+        """
         if location:
-            locations = Location.objects.get(pk = location.pk).get_children()
+            locations = list(Location.objects.get(pk=location.pk).get_children())
+            totals = self.category_totals(locations)
         else:
             locations = [location]
+            totals = self.category_totals()
+        categories = list(self.categories.all())
         categorized_responses = {}
-        
-        #categorized results      
-        for loc in locations:
-            loc_cat = categorized.filter(response__message__connection__contact__reporting_location__in=loc.get_descendants(include_self=True))
-            categorized_responses[loc] = {}
-            categorized_responses[loc] = {'total': loc_cat.count()}
-            for cat in self.categories.all():
-                categorized_responses[loc][cat.name] = loc_cat.filter(category__name=cat.name).count()
-        
-        #append uncategorized results
         for loc in locations:
-            loc_cat = uncategorized.filter(message__connection__contact__reporting_location__in=loc.get_descendants(include_self=True))
-            categorized_responses[loc]['uncategorized'] = loc_cat.count()
-            categorized_responses[loc]['total'] = categorized_responses[loc]['total'] + categorized_responses[loc]['uncategorized']
-                
+            key = loc.pk if loc else None
+            categorized_responses[loc] = {
+                'total': sum([n for (location_id, category_id), n in totals.items() if location_id == key]),
+                'uncategorized': totals.get((key, None), 0),
+            }
+            for cat in categories:
+                categorized_responses[loc][cat.name] = totals.get((key, cat.pk), 0)
         return categorized_responses
+
+    def category_totals(self, locations=None):
+        """
+        The number of responses per (location, category) as computed by
+        rollups.category_totals, read from the materialized counts when this
+        poll has them.
+        """
+        return category_totals(self.pk, locations, materialized=self.counts_materialized)
             
         
 #         for loc in locations:
@@ -695,26 +1274,145 @@ class Poll(models.Model):
 # 
 #         return categorized
 
-    def process_uncategorized(self):
+    def process_uncategorized(self, progress=None):
         responses = self.responses.filter(categories__category=None)
-        for resp in responses:
-            resp.has_errors = False
-            for category in self.categories.all():
-                for rule in category.rules.all():
-                    regex = re.compile(rule.regex, re.IGNORECASE)
-                    if resp.eav.poll_text_value:
-                        if regex.search(resp.eav.poll_text_value.lower()) and not resp.categories.filter(
-                                category=category).count():
-                            if category.error_category:
-                                resp.has_errors = True
-                            rc = ResponseCategory.objects.create(response=resp, category=category)
-                            break
-            if not resp.categories.all().count() and self.categories.filter(default=True).count():
-                if self.categories.get(default=True).error_category:
+        categorizer = self.get_categorizer()
+        for i, resp in enumerate(responses):
+            self._recategorize(resp, categorizer)
+            if progress and not (i + 1) % 100:
+                progress(i + 1)
+
+    def _recategorize(self, resp, categorizer):
+        before = set(resp.categories.values_list('category', flat=True))
+        resp.has_errors = False
+        text = resp.eav.poll_text_value
+        for category in categorizer.categorize(text):
+            if not resp.categories.filter(category=category).count():
+                if category.error_category:
                     resp.has_errors = True
-                resp.categories.add(
-                    ResponseCategory.objects.create(response=resp, category=self.categories.get(default=True)))
-            resp.save()
+                ResponseCategory.objects.create(response=resp, category=category)
+        if categorizer.default and not resp.categories.all().count():
+            if categorizer.default.error_category:
+                resp.has_errors = True
+            ResponseCategory.objects.create(response=resp, category=categorizer.default)
+        resp.save()
+        ResponseCount.objects.record(self, [(resp.pk, before, set(resp.categories.values_list('category', flat=True)))])
+
+    def iter_response_texts(self, chunk_size=None, from_pk=0):
+        """
+        Yields the (response pk, text) pairs of this poll's text responses
+        with a pk above ``from_pk`` in pk order, as lists of at most
+        ``chunk_size`` pairs, reading the eav values directly rather than
+        through each response's eav attribute.
+        """
+        chunk_size = chunk_size or getattr(settings, 'POLL_REPROCESS_CHUNK_SIZE', 500)
+        texts = Value.objects.filter(entity_ct=ContentType.objects.get_for_model(Response),
+                                     attribute__slug='poll_text_value',
+                                     entity_id__in=self.responses.values('pk'))\
+            .order_by('entity_id').values_list('entity_id', 'value_text')
+        last_pk = from_pk
+        while True:
+            chunk = list(texts.filter(entity_id__gt=last_pk)[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1][0]
+
+    def reprocess_rule_change(self, old_regex=None, new_regex=None, progress=None):
+        """
+        Brings the categories of this poll's responses up to date after a
+        single rule changed from ``old_regex`` to ``new_regex`` (either may be
+        None for an added or deleted rule).  Only the responses matching one
+        of the two, plus those currently uncategorized or in the default
+        category, are re-evaluated; the others can't have changed.
+        """
+        self.reprocess_matching([old_regex, new_regex], progress=progress)
+
+    def reprocess_matching(self, regexes, progress=None):
+        """
+        Re-evaluates the responses matching any of ``regexes`` (the old and
+        new versions of changed rules), plus those currently uncategorized or
+        in the default category, with or without a text.  ``progress`` is called with the number of
+        responses looked at so far after each chunk.
+        """
+        patterns = []
+        for regex in regexes:
+            try:
+                if regex:
+                    patterns.append(re.compile(regex, re.IGNORECASE))
+            except re.error:
+                pass
+        categorizer = self.get_categorizer()
+        fallback = set(self.responses.filter(categories=None).values_list('pk', flat=True))
+        if categorizer.default:
+            fallback.update(ResponseCategory.objects.filter(response__poll=self, category=categorizer.default,
+                                                            is_override=False).values_list('response', flat=True))
+
+        changed = processed = 0
+        for chunk in self.iter_response_texts():
+            affected = [(pk, text) for pk, text in chunk
+                        if pk in fallback or (text and any(p.search(text) for p in patterns))]
+            fallback.difference_update([pk for pk, text in chunk])
+            changed += self._recategorize_bulk(affected, categorizer)
+            processed += len(chunk)
+            if progress:
+                progress(processed)
+
+        # responses without a text (numeric or location ones) match no rule,
+        # but still get the default category if they have none
+        textless = sorted(fallback)
+        chunk_size = getattr(settings, 'POLL_REPROCESS_CHUNK_SIZE', 500)
+        for i in range(0, len(textless), chunk_size):
+            chunk = textless[i:i + chunk_size]
+            changed += self._recategorize_bulk([(pk, None) for pk in chunk], categorizer)
+            processed += len(chunk)
+            if progress:
+                progress(processed)
+        self.log_poll_message_info(" rule change recategorized [%d] responses" % changed)
+
+    def _recategorize_bulk(self, responses, categorizer):
+        """
+        Sets the categories and error flag of each of the (pk, text)
+        ``responses`` as _recategorize would, writing only the
+        ResponseCategory rows that differ.  Returns the number of responses
+        whose categories changed.
+        """
+        if not responses:
+            return 0
+        response_ids = [pk for pk, text in responses]
+        current, overridden = {}, {}
+        for response_id, category_id, is_override in ResponseCategory.objects.filter(response__in=response_ids)\
+                .values_list('response', 'category', 'is_override'):
+            (overridden if is_override else current).setdefault(response_id, set()).add(category_id)
+
+        error_categories = set(c.pk for c in categorizer.categories if c.error_category)
+        inserts, deletes, counts = [], {}, []
+        has_errors = {True: [], False: []}
+        for pk, text in responses:
+            overrides = overridden.get(pk, set())
+            wanted = set(c.pk for c in categorizer.categorize(text)) - overrides
+            if not wanted and not overrides and categorizer.default:
+                wanted.add(categorizer.default.pk)
+            existing = current.get(pk, set())
+            for category_id in wanted - existing:
+                inserts.append(ResponseCategory(response_id=pk, category_id=category_id))
+            for category_id in existing - wanted:
+                deletes.setdefault(category_id, []).append(pk)
+            if wanted != existing:
+                counts.append((pk, existing | overrides, wanted | overrides))
+            has_errors[bool(wanted & error_categories)].append(pk)
+
+        for category_id, ids in deletes.items():
+            ResponseCategory.objects.filter(category=category_id, response__in=ids, is_override=False).delete()
+        bulk_create(ResponseCategory, inserts)
+        for flag, ids in has_errors.items():
+            if ids:
+                Response.objects.filter(pk__in=ids).update(has_errors=flag)
+        if counts:
+            Response.objects.filter(pk__in=[pk for pk, before, after in counts])\
+                .update(modified=datetime.datetime.now())
+        ResponseCount.objects.record(self, counts)
+        return len(counts)
 
     def responses_by_age(self, lower_bound_in_years, upper_bound_in_years):
         lower_bound_date = datetime.datetime.now() - relativedelta(years=lower_bound_in_years)
@@ -785,21 +1483,490 @@ class Response(models.Model):
     message = models.ForeignKey(Message, null=True, related_name='poll_responses')
     poll = models.ForeignKey(Poll, related_name='responses')
     contact = models.ForeignKey(Contact, null=True, blank=True, related_name='responses')
+    # migration 0010 indexes it together with poll and pk for the paged
+    # response listing
     date = models.DateTimeField(auto_now_add=True)
     has_errors = models.BooleanField(default=False)
+    # when the response or its categories last changed, for incremental
+    # exports; migration 0008 indexes it together with poll and pk
+    modified = models.DateTimeField(auto_now=True)
 
     def update_categories(self, categories, user):
+        before = set(self.categories.values_list('category', flat=True))
         for c in categories:
             if not self.categories.filter(category=c).count():
                 ResponseCategory.objects.create(response=self, category=c, is_override=True, user=user)
         for rc in self.categories.all():
             if not rc.category in categories:
                 rc.delete()
+        Response.objects.filter(pk=self.pk).update(modified=datetime.datetime.now())
+        ResponseCount.objects.record(self.poll, [(self.pk, before, set(c.pk for c in categories))])
 
 
 register(Response)
 
 
+def _count_contribution(categories):
+    # what one response adds to the counts: one per category, or one to the
+    # uncategorized (None) bucket; a response that doesn't exist adds nothing
+    if categories is None:
+        return {}
+    return dict([(category_id, 1) for category_id in categories]) or {None: 1}
+
+
+class ResponseCountManager(models.Manager):
+
+    def record(self, poll, changes):
+        """
+        Applies categorization changes to the counts of ``poll``.  Each of
+        ``changes`` is a (response pk, category pks before, category pks
+        after) triple, with None for a response that didn't exist before or
+        no longer will after; it must be called while the responses are
+        still in the database.  Polls whose counts aren't materialized are
+        left alone.
+        """
+        changes = [(pk, before, after) for pk, before, after in changes if before != after]
+        if not changes:
+            return
+        invalidate_poll_reports(poll.pk)
+        if not poll.counts_materialized:
+            return
+        keys = {}
+        response_ids = [pk for pk, before, after in changes]
+        for i in range(0, len(response_ids), 500):
+            for pk, location_id, date in Response.objects.filter(pk__in=response_ids[i:i + 500])\
+                    .values_list('pk', 'message__connection__contact__reporting_location', 'date'):
+                keys[pk] = (location_id, date.date())
+
+        deltas = {}
+        for pk, before, after in changes:
+            if pk not in keys:
+                continue
+            location_id, day = keys[pk]
+            for category_id, n in _count_contribution(after).items():
+                key = (category_id, location_id, day)
+                deltas[key] = deltas.get(key, 0) + n
+            for category_id, n in _count_contribution(before).items():
+                key = (category_id, location_id, day)
+                deltas[key] = deltas.get(key, 0) - n
+
+        for (category_id, location_id, day), delta in deltas.items():
+            if not delta:
+                continue
+            # several rows for the same key are harmless, reads sum them
+            row = list(self.filter(poll=poll, category=category_id, location=location_id, day=day)
+                       .values_list('pk', flat=True)[:1])
+            if row:
+                self.filter(pk=row[0]).update(count=F('count') + delta)
+            else:
+                self.create(poll=poll, category_id=category_id, location_id=location_id, day=day, count=delta)
+
+    @transaction.commit_on_success
+    def rebuild(self, poll):
+        """
+        Recomputes the counts of ``poll`` from its responses and marks them
+        materialized.  Needed for polls with responses from before the counts
+        existed, after a category is deleted, and to pick up contacts that
+        changed their reporting location.
+        """
+        counts = {}
+        categorized = ResponseCategory.objects.filter(response__poll=poll)\
+            .values_list('category', 'response__message__connection__contact__reporting_location', 'response__date')
+        uncategorized = poll.responses.filter(categories=None)\
+            .values_list('message__connection__contact__reporting_location', 'date')
+        for category_id, location_id, date in categorized.iterator():
+            key = (category_id, location_id, date.date())
+            counts[key] = counts.get(key, 0) + 1
+        for location_id, date in uncategorized.iterator():
+            key = (None, location_id, date.date())
+            counts[key] = counts.get(key, 0) + 1
+
+        self.filter(poll=poll).delete()
+        bulk_create(ResponseCount, [ResponseCount(poll=poll, category_id=category_id, location_id=location_id,
+                                                  day=day, count=count)
+                                    for (category_id, location_id, day), count in counts.items()])
+        Poll.objects.filter(pk=poll.pk).update(counts_materialized=True)
+        poll.counts_materialized = True
+        invalidate_poll_reports(poll.pk)
+
+
+class ResponseCount(models.Model):
+    """
+    The number of responses of a poll per category, reporting location and
+    day, kept up to date as responses are processed, recategorized, edited
+    and deleted so that reports don't have to count responses.  A null
+    category counts uncategorized responses.  There can be more than one row
+    for the same poll, category, location and day; they add up.
+    """
+    poll = models.ForeignKey(Poll, related_name='response_counts')
+    category = models.ForeignKey(Category, null=True)
+    location = models.ForeignKey(Location, null=True)
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+
+    objects = ResponseCountManager()
+
+
+class StartProgress(models.Model):
+    """
+    The progress of a poll started with Poll.start_streaming, updated as each
+    chunk of outgoing messages is committed; a start with no completed date
+    was interrupted and can be resumed from last_connection.  A parallel
+    start has one of these per partition of the recipients.
+    """
+    poll = models.ForeignKey(Poll, related_name='start_progress')
+    recipients = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    chunks = models.IntegerField(default=0)
+    # pk of the last connection whose chunk has been committed
+    last_connection = models.IntegerField(default=0)
+    # pk of the last connection of this partition of a parallel start
+    upper = models.IntegerField(null=True)
+    started = models.DateTimeField(auto_now_add=True)
+    completed = models.DateTimeField(null=True)
+
+
+class ReprocessJobManager(models.Manager):
+
+    def enqueue(self, poll, kind, regexes=()):
+        """
+        Queues a reprocessing of ``poll`` and returns its job.  A job still
+        queued for the poll absorbs the new request instead (the broader kind
+        wins and rule regexes are merged), so a burst of rule edits results
+        in a single run.
+        """
+        regexes = [regex for regex in regexes if regex]
+        with transaction.commit_on_success():
+            queued = list(self.select_for_update().filter(poll=poll, status=ReprocessJob.STATUS_QUEUED)[:1])
+            if queued:
+                job = queued[0]
+                if ReprocessJob.KINDS.index(kind) > ReprocessJob.KINDS.index(job.kind):
+                    job.kind = kind
+                job.set_regexes(job.get_regexes() + [regex for regex in regexes if regex not in job.get_regexes()])
+                job.save()
+                return job
+            job = self.create(poll=poll, kind=kind, regexes=simplejson.dumps(regexes))
+        run_reprocess_job.delay(job.pk)
+        return job
+
+
+class ReprocessJob(models.Model):
+    """
+    A reprocessing of a poll's responses run in the background by the
+    run_reprocess_job task, with enough bookkeeping to report its progress.
+    """
+    KIND_UNCATEGORIZED = 'u'
+    KIND_RULES = 'r'
+    KIND_ALL = 'a'
+    # narrowest first, each kind covers the ones before it
+    KINDS = [KIND_UNCATEGORIZED, KIND_RULES, KIND_ALL]
+    KIND_CHOICES = (
+        (KIND_UNCATEGORIZED, 'Uncategorized responses'),
+        (KIND_RULES, 'Responses affected by rule changes'),
+        (KIND_ALL, 'All responses'),
+    )
+
+    STATUS_QUEUED = 'Q'
+    STATUS_RUNNING = 'R'
+    STATUS_DONE = 'D'
+    STATUS_FAILED = 'F'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    poll = models.ForeignKey(Poll, related_name='reprocess_jobs')
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    # json list of the old and new regexes of the changed rules
+    regexes = models.TextField(default='[]')
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    objects = ReprocessJobManager()
+
+    def get_regexes(self):
+        return simplejson.loads(self.regexes)
+
+    def set_regexes(self, regexes):
+        self.regexes = simplejson.dumps(regexes)
+
+    def set_progress(self, processed):
+        ReprocessJob.objects.filter(pk=self.pk).update(processed=processed)
+
+    def run(self):
+        """
+        Runs the job unless it has already been picked up, returning False if
+        it has to wait for another job of the same poll to finish first.
+        """
+        now = datetime.datetime.now()
+        running = ReprocessJob.objects.filter(poll=self.poll_id, status=ReprocessJob.STATUS_RUNNING)
+        # a job running for this long was lost along with its worker
+        stale = now - datetime.timedelta(seconds=getattr(settings, 'POLL_REPROCESS_TIMEOUT', 60 * 60))
+        running.filter(started__lt=stale).update(status=ReprocessJob.STATUS_FAILED, finished=now)
+        if running.exists():
+            return False
+        if not ReprocessJob.objects.filter(pk=self.pk, status=ReprocessJob.STATUS_QUEUED)\
+                .update(status=ReprocessJob.STATUS_RUNNING, started=now):
+            return True
+        # a queued job may have absorbed more work until now
+        job = ReprocessJob.objects.select_related('poll').get(pk=self.pk)
+        poll = job.poll
+        try:
+            if job.kind == ReprocessJob.KIND_UNCATEGORIZED:
+                job.total = poll.responses.filter(categories__category=None).count()
+                job.save()
+                poll.process_uncategorized(progress=job.set_progress)
+            elif job.kind == ReprocessJob.KIND_RULES:
+                job.total = poll.responses.count()
+                job.save()
+                poll.reprocess_matching(job.get_regexes(), progress=job.set_progress)
+            else:
+                job.total = poll.responses.count()
+                job.save()
+                poll.reprocess_responses(progress=job.set_progress)
+            ReprocessJob.objects.filter(pk=job.pk).update(status=ReprocessJob.STATUS_DONE, processed=job.total,
+                                                          finished=datetime.datetime.now())
+        except Exception:
+            log.exception("[ReprocessJob] reprocessing poll %d failed" % poll.pk)
+            ReprocessJob.objects.filter(pk=job.pk).update(status=ReprocessJob.STATUS_FAILED,
+                                                          finished=datetime.datetime.now())
+        return True
+
+    def as_dict(self):
+        return {'id': self.pk, 'poll': self.poll_id, 'kind': self.kind, 'status': self.status,
+                'total': self.total, 'processed': self.processed}
+
+
+class ExportJobManager(models.Manager):
+
+    def request(self, poll):
+        """
+        Returns a job exporting the responses of ``poll``: one already done,
+        running or queued if the poll hasn't changed since it was requested,
+        otherwise a new one queued for the run_export_job task.
+        """
+        fingerprint = ExportJob.fingerprint(poll)
+        with transaction.commit_on_success():
+            for job in self.select_for_update().filter(poll=poll, fingerprint=fingerprint)\
+                    .exclude(status=ExportJob.STATUS_FAILED).order_by('-pk'):
+                if job.status != ExportJob.STATUS_DONE or os.path.exists(job.path):
+                    return job
+            job = self.create(poll=poll, fingerprint=fingerprint)
+        run_export_job.delay(job.pk)
+        return job
+
+
+class ExportJob(models.Model):
+    """
+    A CSV export of a poll's responses written in the background by the
+    run_export_job task to a gzip-compressed file under POLL_EXPORT_ROOT.
+    """
+    STATUS_QUEUED = 'Q'
+    STATUS_RUNNING = 'R'
+    STATUS_DONE = 'D'
+    STATUS_FAILED = 'F'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    poll = models.ForeignKey(Poll, related_name='export_jobs')
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    # what the poll looked like when the export was requested, see fingerprint()
+    fingerprint = models.CharField(max_length=32, db_index=True)
+    path = models.CharField(max_length=255, blank=True)
+    rows = models.IntegerField(default=0)
+    size = models.IntegerField(default=0)
+    duration = models.FloatField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    objects = ExportJobManager()
+
+    @classmethod
+    def fingerprint(cls, poll):
+        """
+        A digest of everything the export of ``poll`` is made of that can
+        change: its responses (their number, the latest pk and the latest
+        modification, which follows recategorizations) and its categories.
+        """
+        responses = poll.responses.aggregate(Count('pk'), Max('pk'), Max('modified'))
+        categories = list(poll.categories.order_by('pk').values_list('pk', 'name'))
+        return hashlib.md5(repr((poll.type, sorted(responses.items()), categories))).hexdigest()
+
+    def get_filename(self):
+        return 'poll-%d-%d.csv.gz' % (self.poll_id, self.pk)
+
+    def run(self):
+        from .export import iter_responses_csv
+        if not ExportJob.objects.filter(pk=self.pk, status=ExportJob.STATUS_QUEUED)\
+                .update(status=ExportJob.STATUS_RUNNING, started=datetime.datetime.now()):
+            return
+        root = getattr(settings, 'POLL_EXPORT_ROOT', None) or \
+            os.path.join(settings.MEDIA_ROOT or tempfile.gettempdir(), 'poll_exports')
+        path = os.path.join(root, self.get_filename())
+        counts = [0]
+
+        def progress(rows):
+            counts[0] = rows
+
+        started = time.time()
+        try:
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            poll = Poll.objects.get(pk=self.poll_id)
+            out = gzip.open(path, 'wb')
+            try:
+                for data in iter_responses_csv(poll, progress=progress):
+                    out.write(data)
+            finally:
+                out.close()
+            ExportJob.objects.filter(pk=self.pk).update(status=ExportJob.STATUS_DONE, path=path, rows=counts[0],
+                                                        size=os.path.getsize(path),
+                                                        duration=time.time() - started,
+                                                        finished=datetime.datetime.now())
+        except Exception:
+            log.exception("[ExportJob] exporting poll %d failed" % self.poll_id)
+            ExportJob.objects.filter(pk=self.pk).update(status=ExportJob.STATUS_FAILED,
+                                                        finished=datetime.datetime.now())
+            return
+        # earlier exports of the poll are superseded by this one
+        for job in ExportJob.objects.filter(poll=self.poll_id, status=ExportJob.STATUS_DONE, pk__lt=self.pk):
+            if job.path and os.path.exists(job.path):
+                os.remove(job.path)
+            job.delete()
+
+    def get_download_url(self):
+        return reverse('poll-export-download', kwargs={'poll_id': self.poll_id, 'job_id': self.pk})
+
+    def as_dict(self):
+        return {'id': self.pk, 'poll': self.poll_id, 'status': self.status, 'rows': self.rows,
+                'size': self.size, 'duration': self.duration,
+                'url': self.get_download_url() if self.status == ExportJob.STATUS_DONE else None}
+
+
+# contact pk -> pk of the poll its messages are routed to; contacts without
+# one aren't kept
+_active_polls = VersionedCache('active-polls',
+                               max_size=getattr(settings, 'POLL_ACTIVE_CACHE_SIZE', 100000))
+
+
+class ActivePollManager(models.Manager):
+
+    def get_poll_for(self, contact):
+        """
+        Returns the poll that incoming messages from ``contact`` should be
+        processed by: the most recently started poll the contact belongs to
+        that hasn't ended yet.  Raises Poll.DoesNotExist if there is none.
+
+        The answer comes from the per-process cache, then from the persisted
+        mapping, and only when both miss from the poll-contacts join (whose
+        result is then persisted).  Contacts without a poll aren't cached,
+        so a poll started meanwhile is always found.
+        """
+        poll_id = _active_polls.get(contact.pk)
+        if poll_id is None:
+            poll_ids = list(self.filter(contact=contact).values_list('poll', flat=True)[:1])
+            if poll_ids:
+                poll_id = poll_ids[0]
+            else:
+                poll_id = self._resolve(contact)
+            if poll_id is not None:
+                _active_polls.set(contact.pk, poll_id)
+
+        poll = None
+        if poll_id is not None:
+            try:
+                poll = Poll.objects.get(pk=poll_id)
+            except Poll.DoesNotExist:
+                pass
+            if poll is None or not poll.is_active():
+                # deleted, or past an end date that was set ahead of time
+                poll_id = self._resolve(contact)
+                poll = None
+                if poll_id is not None:
+                    _active_polls.set(contact.pk, poll_id)
+                    poll = Poll.objects.get(pk=poll_id)
+
+        if poll is None:
+            raise Poll.DoesNotExist
+        return poll
+
+    def _resolve(self, contact):
+        try:
+            poll_id = Poll.objects.filter(contacts=contact).exclude(start_date=None)\
+                .filter(Q(end_date=None) | (~Q(end_date=None) & Q(end_date__gt=datetime.datetime.now())))\
+                .latest('start_date').pk
+        except Poll.DoesNotExist:
+            poll_id = None
+        if not self.filter(contact=contact).update(poll=poll_id):
+            if not try_insert(self.create, contact=contact, poll_id=poll_id):
+                # created by a concurrent lookup or poll start meanwhile
+                self.filter(contact=contact).update(poll=poll_id)
+        return poll_id
+
+    def poll_started(self, poll):
+        """
+        A poll that has just started is the current poll of all its contacts.
+        """
+        sql = "INSERT INTO %(active)s (contact_id, poll_id) " \
+              "SELECT pc.contact_id, pc.poll_id FROM %(contacts)s pc " \
+              "WHERE pc.poll_id = %%s AND NOT EXISTS " \
+              "(SELECT 1 FROM %(active)s ap WHERE ap.contact_id = pc.contact_id)" % {
+                  'active': self.model._meta.db_table,
+                  'contacts': Poll.contacts.through._meta.db_table,
+              }
+        self.filter(contact__polls=poll).update(poll=poll)
+        while not try_insert(execute_sql, sql, [poll.pk]):
+            # a lookup created some contact's row in the meantime
+            self.filter(contact__polls=poll).update(poll=poll)
+        _active_polls.invalidate()
+
+    def poll_ended(self, poll):
+        """
+        Forgets the contacts routed to ``poll``; they may still belong to an
+        older active poll, which is looked up again on their next message.
+        """
+        execute_sql("DELETE FROM %s WHERE poll_id = %%s" % self.model._meta.db_table, [poll.pk])
+        _active_polls.invalidate()
+
+    def contacts_changed(self, poll):
+        """
+        To be called whenever the contacts of ``poll`` are modified.
+        """
+        if not poll.is_active():
+            return
+        execute_sql(
+            "DELETE FROM %(active)s WHERE poll_id = %%s OR contact_id IN "
+            "(SELECT contact_id FROM %(contacts)s WHERE poll_id = %%s)" % {
+                'active': self.model._meta.db_table,
+                'contacts': Poll.contacts.through._meta.db_table,
+            }, [poll.pk, poll.pk])
+        _active_polls.invalidate()
+
+
+class ActivePoll(models.Model):
+    """
+    The poll a contact's incoming messages are currently routed to, kept up to
+    date as polls are started, ended and edited so that the router doesn't
+    have to search the poll-contacts table for every message.  A null poll
+    records that the contact has no active poll.
+    """
+    contact = models.OneToOneField(Contact, related_name='active_poll')
+    poll = models.ForeignKey(Poll, null=True, related_name='active_contacts')
+
+    objects = ActivePollManager()
+
+
 class Rule(models.Model):
     """
     A rule is a regular expression that an incoming message text might
@@ -862,6 +2029,13 @@ class Rule(models.Model):
     def save(self, *args, **kwargs):
         if self.rule:
             self.regex = self.get_regex()
+        # every rule is run against every incoming message of the poll, so a
+        # pattern that can backtrack for ages isn't saved however it's made;
+        # one RuleForm already timed (against the poll's responses too) isn't
+        # timed again
+        if self.regex and (not self.pk or Rule.objects.filter(pk=self.pk).exclude(regex=self.regex).exists()) \
+                and not is_fast_enough_cached(self.regex):
+            raise ValidationError("The rule [%s] takes too long to evaluate" % self.regex)
         super(Rule, self).save()
 
     @property
@@ -890,15 +2064,185 @@ class Translation(models.Model):
         unique_together = ('field', 'language')
 
 
+def invalidate_categorizers(sender, **kwargs):
+    _categorizers.invalidate()
+
+
+for sender in (Category, Rule):
+    post_save.connect(invalidate_categorizers, sender=sender)
+    post_delete.connect(invalidate_categorizers, sender=sender)
+
+
+def unmaterialize_counts(sender, instance, **kwargs):
+    # the category's counts are gone with it and some of its responses may
+    # now be uncategorized; reports count live until the next rebuild
+    Poll.objects.filter(pk=instance.poll_id).update(counts_materialized=False)
+
+
+post_delete.connect(unmaterialize_counts, sender=Category)
+
+
+def _touch_category_responses(category):
+    # for incremental exports, which list each response's category names
+    Response.objects.filter(categories__category=category).update(modified=datetime.datetime.now())
+
+
+def category_renamed(sender, instance, **kwargs):
+    if instance.pk and Category.objects.filter(pk=instance.pk).exclude(name=instance.name).exists():
+        _touch_category_responses(instance)
+
+
+def category_deleted(sender, instance, **kwargs):
+    _touch_category_responses(instance)
+
+
+pre_save.connect(category_renamed, sender=Category)
+pre_delete.connect(category_deleted, sender=Category)
+
+
+def uncount_response(sender, instance, **kwargs):
+    # however a response goes (replaced by a new answer to a one response
+    # poll, deleted along with its contact or message...), it leaves the
+    # counts while its categories are still there to read
+    ResponseCount.objects.record(instance.poll, [(instance.pk,
+            set(instance.categories.values_list('category', flat=True)), None)])
+
+
+pre_delete.connect(uncount_response, sender=Response)
+
+
+def poll_reports_changed(sender, instance, **kwargs):
+    invalidate_poll_reports(instance.poll_id)
+
+
+for sender in (Response, Category):
+    post_save.connect(poll_reports_changed, sender=sender)
+    post_delete.connect(poll_reports_changed, sender=sender)
+
+
+def contact_reports_changed(sender, instance, **kwargs):
+    # reports break responses down by their contact's gender, age and
+    # reporting location, whether the contact is the response's own or that
+    # of its message's connection
+    poll_ids = set(Response.objects.filter(contact=instance).values_list('poll', flat=True).distinct())
+    poll_ids.update(Response.objects.filter(message__connection__contact=instance)
+                    .values_list('poll', flat=True).distinct())
+    for poll_id in poll_ids:
+        invalidate_poll_reports(poll_id)
+
+
+post_save.connect(contact_reports_changed, sender=Contact)
+
+
+def _translation_key(field):
+    if isinstance(field, unicode):
+        field = field.encode('utf-8')
+    return hashlib.md5(field).hexdigest()
+
+
 def gettext_db(field, language):
-    #if name exists in po file get it else look
-    if Translation.objects.filter(field=field, language=language).exists():
-        return Translation.objects.filter(field=field, language=language)[0].value
+    """
+    Translates ``field`` into ``language`` using the Translation table, or
+    the gettext catalog if the table has no translation for it.  With a
+    shared cache backend the table is loaded once per language and process
+    (and reloaded after any change to it), so translating doesn't cost any
+    queries; without one each call looks up its own row.
+    """
+    if cache_is_shared():
+        translations = _translations.get(language)
+        if translations is None:
+            translations = dict([(_translation_key(f), v) for f, v in
+                                 Translation.objects.filter(language=language).values_list('field', 'value')])
+            _translations.set(language, translations)
+        translated = translations.get(_translation_key(field))
     else:
-        activate(language)
-        lang_str = ugettext(field)
-        deactivate()
-        return lang_str
+        values = list(Translation.objects.filter(field=field, language=language).values_list('value', flat=True)[:1])
+        translated = values[0] if values else None
+    if translated is not None:
+        return translated
+    if settings.USE_I18N:
+        # the catalog activate() would install, without switching the active
+        # language of the thread back and forth; line endings are normalized
+        # as ugettext's do_translate does
+        eol_field = field.replace('\r\n', '\n').replace('\r', '\n')
+        return trans_real.translation(language).ugettext(eol_field)
+    return ugettext(field)
+
+
+def invalidate_translations(sender, **kwargs):
+    _translations.invalidate()
+
+
+post_save.connect(invalidate_translations, sender=Translation)
+post_delete.connect(invalidate_translations, sender=Translation)
+
+
+@task
+def release_message_batches(poll_pk, attempt=0):
+    """
+    Releases the batches of a poll the backends can take now, then runs
+    again after POLL_RELEASE_INTERVAL seconds until none are left.  Until
+    the transaction starting the poll commits, neither the start date nor
+    the batches are visible, and the task tries again a little later.
+    """
+    interval = getattr(settings, 'POLL_RELEASE_INTERVAL', 60)
+    try:
+        poll = Poll.objects.exclude(start_date=None).get(pk=poll_pk)
+    except Poll.DoesNotExist:
+        if attempt < getattr(settings, 'POLL_RELEASE_RETRIES', 10):
+            release_message_batches.apply_async(args=[poll_pk, attempt + 1], countdown=interval)
+        return
+    if poll.release_batches():
+        release_message_batches.apply_async(args=[poll_pk], countdown=interval)
+
+
+@task
+def run_reprocess_job(job_pk, attempt=0):
+    """
+    Runs a ReprocessJob, trying again a little later if the job isn't
+    visible yet (the enqueuing transaction hasn't committed) or if another
+    job of the same poll is still running.
+    """
+    delay = getattr(settings, 'POLL_REPROCESS_RETRY_DELAY', 10)
+    try:
+        job = ReprocessJob.objects.get(pk=job_pk)
+    except ReprocessJob.DoesNotExist:
+        if attempt < 5:
+            run_reprocess_job.apply_async(args=[job_pk, attempt + 1], countdown=delay)
+        return
+    if not job.run():
+        run_reprocess_job.apply_async(args=[job_pk, attempt], countdown=delay)
+
+
+@task
+def run_export_job(job_pk, attempt=0):
+    """
+    Runs an ExportJob, trying again a little later if the job isn't visible
+    yet because the requesting transaction hasn't committed.
+    """
+    try:
+        job = ExportJob.objects.get(pk=job_pk)
+    except ExportJob.DoesNotExist:
+        if attempt < 5:
+            run_export_job.apply_async(args=[job_pk, attempt + 1],
+                                       countdown=getattr(settings, 'POLL_REPROCESS_RETRY_DELAY', 10))
+        return
+    job.run()
+
+
+@task
+def start_poll_partition(progress_pk, chunk_size=None):
+    progress = StartProgress.objects.select_related('poll').get(pk=progress_pk)
+    progress.poll._finish_start(progress, chunk_size)
+
+
+@task
+def rebuild_response_counts(poll_pk):
+    try:
+        poll = Poll.objects.get(pk=poll_pk)
+    except Poll.DoesNotExist:
+        return
+    ResponseCount.objects.rebuild(poll)
 
 
 @task
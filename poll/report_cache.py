@@ -0,0 +1,79 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .utils import VERSION_TIMEOUT, cache_is_shared
+
+# how long a computed report is kept; it never goes stale before that, as
+# changes to the poll's responses, its categories and the contacts who
+# responded all move the poll to a new version
+REPORT_TIMEOUT = 60 * 60 * 24
+
+
+def _version_key(poll_pk):
+    return 'poll-report-version-%s' % poll_pk
+
+
+def _get_version(poll_pk):
+    key = _version_key(poll_pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_poll_reports(poll_pk):
+    """
+    Moves ``poll_pk`` to a new version, so every report cached for it is
+    computed again on its next request.  Called whenever the poll's
+    responses, their categories, the poll's categories or the details of a
+    contact who responded change.
+    """
+    # a fresh token rather than a counter, as in VersionedCache
+    cache.set(_version_key(poll_pk), uuid.uuid4().hex, VERSION_TIMEOUT)
+
+
+def _count(name):
+    key = 'poll-report-cache-%s' % name
+    if not cache.add(key, 1, VERSION_TIMEOUT):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, VERSION_TIMEOUT)
+
+
+def get_report(poll_pk, kind, compute, location=None, params=()):
+    """
+    Returns the ``kind`` report of a poll for ``location`` (a pk) and
+    ``params``, calling ``compute`` only if it isn't cached for the poll's
+    current version.  Without a shared cache backend the invalidations made
+    by other processes (the router, say) wouldn't be seen, so reports are
+    always computed.
+    """
+    if not cache_is_shared():
+        _count('misses')
+        return compute()
+    version = _get_version(poll_pk)
+    key = 'poll-report-%s' % hashlib.md5(repr((poll_pk, kind, location, tuple(params), version))).hexdigest()
+    report = cache.get(key)
+    if report is not None:
+        _count('hits')
+        return report
+    _count('misses')
+    report = compute()
+    cache.set(key, report, getattr(settings, 'POLL_REPORT_CACHE_TIMEOUT', REPORT_TIMEOUT))
+    return report
+
+
+def report_cache_stats():
+    """
+    The number of report requests served from the cache and computed, over
+    every process sharing the cache backend.
+    """
+    return {
+        'hits': cache.get('poll-report-cache-hits', 0),
+        'misses': cache.get('poll-report-cache-misses', 0),
+    }
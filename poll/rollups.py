@@ -0,0 +1,52 @@
+from django.db import connection
+
+# where the (response, category) pairs of a poll come from: the responses
+# themselves, or the materialized ResponseCount rows
+LIVE = {
+    'from': 'poll_response r '
+            'LEFT OUTER JOIN poll_responsecategory rc ON rc.response_id = r.id',
+    'located': 'INNER JOIN rapidsms_httprouter_message m ON m.id = r.message_id '
+               'INNER JOIN rapidsms_connection cn ON cn.id = m.connection_id '
+               'INNER JOIN rapidsms_contact ct ON ct.id = cn.contact_id '
+               'INNER JOIN locations_location l ON l.id = ct.reporting_location_id',
+    'poll': 'r.poll_id',
+    'category': 'rc.category_id',
+    'value': 'COUNT(*)',
+}
+
+MATERIALIZED = {
+    'from': 'poll_responsecount rc',
+    'located': 'INNER JOIN locations_location l ON l.id = rc.location_id',
+    'poll': 'rc.poll_id',
+    'category': 'rc.category_id',
+    'value': 'SUM(rc.count)',
+}
+
+
+def category_totals(poll_pk, locations=None, materialized=False):
+    """
+    Counts the responses of a poll per category, None standing for
+    uncategorized responses, with a single grouped query.  Returns
+    {(location pk, category pk): count} where each of ``locations`` counts
+    the responses of contacts reporting from anywhere in its subtree (found
+    from the nested set bounds), or {(None, category pk): count} over every
+    response without ``locations``.  Only non-zero counts are returned.
+    """
+    source = MATERIALIZED if materialized else LIVE
+    if locations is None:
+        sql = 'SELECT NULL, %(category)s, %(value)s FROM %(from)s ' \
+              'WHERE %(poll)s = %%s GROUP BY %(category)s' % source
+        params = [poll_pk]
+    else:
+        location_ids = [location.pk for location in locations]
+        if not location_ids:
+            return {}
+        sql = 'SELECT T.id, %(category)s, %(value)s FROM %(from)s %(located)s ' \
+              'INNER JOIN locations_location T ON T.tree_id = l.tree_id AND T.lft <= l.lft AND T.rght >= l.rght ' \
+              'WHERE %(poll)s = %%s AND T.id IN (%(ids)s) ' \
+              'GROUP BY T.id, %(category)s' % dict(source, ids=', '.join(['%s'] * len(location_ids)))
+        params = [poll_pk] + location_ids
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return dict([((location_id, category_id), int(count))
+                 for location_id, category_id, count in cursor.fetchall() if count])
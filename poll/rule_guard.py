@@ -0,0 +1,170 @@
+import multiprocessing
+import re
+import sre_parse
+import time
+
+from sre_constants import LITERAL, NOT_LITERAL, IN, RANGE, CATEGORY, ANY, MAX_REPEAT, MIN_REPEAT, \
+    SUBPATTERN, BRANCH, ASSERT, ASSERT_NOT, GROUPREF_EXISTS, CATEGORY_DIGIT, CATEGORY_NOT_DIGIT, \
+    CATEGORY_SPACE, CATEGORY_NOT_SPACE, CATEGORY_WORD, CATEGORY_NOT_WORD, CATEGORY_LINEBREAK, \
+    CATEGORY_NOT_LINEBREAK
+from django.conf import settings
+
+# the length of an SMS, as long as the texts rules are run against get
+SMS_LENGTH = 160
+
+# a character of each class the pattern may use
+CATEGORY_SAMPLES = {
+    CATEGORY_DIGIT: u'1',
+    CATEGORY_NOT_DIGIT: u'a',
+    CATEGORY_SPACE: u' ',
+    CATEGORY_NOT_SPACE: u'a',
+    CATEGORY_WORD: u'a',
+    CATEGORY_NOT_WORD: u'!',
+    CATEGORY_LINEBREAK: u'\n',
+    CATEGORY_NOT_LINEBREAK: u'a',
+}
+
+# beyond this many characters of the pattern, only its first ones are paired
+MAX_PAIRED_CHARACTERS = 12
+
+
+def _pattern_units(pattern, chars, literals):
+    """
+    Collects the characters ``pattern`` (a parsed regex) matches, from its
+    literals and character classes, into ``chars`` and its runs of literal
+    characters into ``literals``.
+    """
+    run = []
+    for op, av in pattern:
+        if op == LITERAL:
+            run.append(unichr(av).lower())
+            chars.add(run[-1])
+            continue
+        if len(run) > 1:
+            literals.add(u''.join(run))
+        run = []
+        if op == NOT_LITERAL:
+            chars.add(u'a' if unichr(av).lower() != u'a' else u'b')
+        elif op == IN:
+            for item_op, item_av in av:
+                if item_op == LITERAL:
+                    chars.add(unichr(item_av).lower())
+                elif item_op == RANGE:
+                    chars.update([unichr(item_av[0]).lower(), unichr(item_av[1]).lower()])
+                elif item_op == CATEGORY and item_av in CATEGORY_SAMPLES:
+                    chars.add(CATEGORY_SAMPLES[item_av])
+        elif op == ANY:
+            chars.add(u'a')
+        elif op in (MAX_REPEAT, MIN_REPEAT):
+            _pattern_units(av[2], chars, literals)
+        elif op == SUBPATTERN:
+            _pattern_units(av[-1], chars, literals)
+        elif op == BRANCH:
+            for branch in av[1]:
+                _pattern_units(branch, chars, literals)
+        elif op in (ASSERT, ASSERT_NOT):
+            _pattern_units(av[1], chars, literals)
+        elif op == GROUPREF_EXISTS:
+            for branch in av[1:]:
+                if branch:
+                    _pattern_units(branch, chars, literals)
+    if len(run) > 1:
+        literals.add(u''.join(run))
+
+
+def adversarial_texts(regex=None, length=SMS_LENGTH):
+    """
+    Texts that make patterns with nested or overlapping quantifiers, such as
+    ``(a+)+$``, ``^(\d+)*$`` or ``(x+x+)+y``, backtrack exponentially: SMS
+    length runs of one character, of two alternating ones or of a literal
+    part of the pattern, bare or followed by a character that breaks the
+    match.  The characters come from the pattern's own literals and
+    character classes, on top of a few common ones.
+    """
+    chars, literals = set(), set()
+    if regex:
+        try:
+            _pattern_units(sre_parse.parse(regex), chars, literals)
+        except (re.error, ValueError):
+            pass
+    breaker = ([c for c in u'!#~' if c not in chars] or [u'!'])[0]
+    paired = sorted(chars)[:MAX_PAIRED_CHARACTERS]
+    units = set([u'a', u'1', u' ', u'ab', u'a1', u'a ', u'.'])
+    units.update(chars)
+    units.update(literals)
+    units.update([a + b for a in paired for b in paired if a != b])
+
+    texts = []
+    for unit in sorted(units):
+        run = unit * (length // len(unit))
+        texts.extend([run, run + breaker, breaker + run + breaker])
+    return texts
+
+
+def _search_all(regex, texts, current):
+    compiled = re.compile(regex, re.IGNORECASE)
+    for i, text in enumerate(texts):
+        current.value = i
+        compiled.search(text.lower())
+    current.value = len(texts)
+
+
+def rule_cost(regex, texts, budget):
+    """
+    Returns how many seconds ``regex`` takes to search all of ``texts`` the
+    way the categorizer does, or None if any single text needs more than
+    ``budget``.  Python's re module can't be interrupted mid-match, so the
+    searches run in a child process, which is killed as soon as it has been
+    on the same text for longer than the budget.
+    """
+    current = multiprocessing.Value('i', -1)
+    process = multiprocessing.Process(target=_search_all, args=(regex, texts, current))
+    started = time.time()
+    process.start()
+    index, since = -1, started
+    while process.is_alive():
+        process.join(budget / 4)
+        now = time.time()
+        if current.value != index:
+            index, since = current.value, now
+        elif index >= 0 and now - since > budget:
+            process.terminate()
+            process.join()
+            return None
+    return time.time() - started
+
+
+def is_fast_enough(regex, sample_texts=()):
+    """
+    Whether ``regex`` searches each of its adversarial texts plus
+    ``sample_texts`` (real responses, say) within POLL_RULE_TIME_BUDGET
+    seconds.
+    """
+    budget = getattr(settings, 'POLL_RULE_TIME_BUDGET', 0.05)
+    fast = rule_cost(regex, adversarial_texts(regex) + list(sample_texts), budget) is not None
+    if fast:
+        # passing with the sample texts means passing without them too
+        _remember(regex, True)
+    return fast
+
+
+# regex -> whether it passed is_fast_enough against the adversarial texts
+_verdicts = {}
+
+
+def _remember(regex, verdict):
+    if len(_verdicts) >= 10000:
+        _verdicts.clear()
+    _verdicts[regex] = verdict
+
+
+def is_fast_enough_cached(regex):
+    """
+    is_fast_enough(regex) against the adversarial texts alone, remembered
+    per process, for checking stored rules every time a categorizer is
+    built (or a rule RuleForm let through is saved) without timing each of
+    them again.
+    """
+    if regex not in _verdicts:
+        _remember(regex, is_fast_enough(regex))
+    return _verdicts[regex]
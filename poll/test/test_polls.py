@@ -55,6 +55,21 @@ class TestBatchSending(TestCase):
 
         self.assertEqual(poll.is_ready_to_send(), True)
 
+    def test_batches_per_backend_are_held_until_released(self):
+        settings.FEATURE_PREPARE_SEND_POLL = True
+        settings.FEATURE_BATCH_PER_BACKEND = True
+
+        poll = self.create_and_start_poll("PBB")
+        connection = Connection.objects.get(backend__name="TBSPBB")
+
+        batch = poll.get_outgoing_message_batches().get()
+        self.assertEqual(batch.name, poll.get_backend_batch_name("TBSPBB", connection.pk))
+        self.assertEqual(batch.status, "P")
+        self.assertEqual(poll.is_ready_to_send(), True)
+
+        self.assertEqual(poll.release_batches(), 0)
+        self.assertEqual(MessageBatch.objects.get(pk=batch.pk).status, "Q")
+
     def create_and_start_poll(self, uniqueness):
         poll_user = User.objects.create(username="TBS_USER_POLL" + uniqueness, email='foo@foo.com')
         contact_user = User.objects.create(username="TBS_USER_CONTACT" + uniqueness, email='foo@foo.com')
@@ -75,10 +90,11 @@ class TestBatchSending(TestCase):
 
 
     def clear_settings(self):
-        try:
-            delattr(settings, "FEATURE_PREPARE_SEND_POLL")
-        except AttributeError:
-            pass
+        for flag in ["FEATURE_PREPARE_SEND_POLL", "FEATURE_BATCH_PER_BACKEND"]:
+            try:
+                delattr(settings, flag)
+            except AttributeError:
+                pass
 
 
 
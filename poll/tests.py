@@ -1,11 +1,30 @@
 from django.test import TestCase
-from poll.models import STARTSWITH_PATTERN_TEMPLATE
+from poll.models import STARTSWITH_PATTERN_TEMPLATE, CONTAINS_PATTERN_TEMPLATE
+from poll.categorizer import Categorizer
+from poll.location_index import LocationIndex
+from poll.rule_guard import rule_cost, adversarial_texts, is_fast_enough
+from poll.report_cache import get_report, report_cache_stats
+from poll.export import iter_responses_csv, changed_responses
+from poll import columnar
+from poll.listing import response_page
+from poll.utils import try_insert, VersionedCache
+from django.utils.unittest import skipIf
+from django.test.utils import override_settings
+import datetime
+import difflib
+import gzip
+import os
 import re
+import shutil
+import tempfile
 
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 
 from rapidsms.models import Contact, Connection, Backend
-from poll.models import Poll, Response, Category, Rule,Translation
+from rapidsms.contrib.locations.models import Location
+from poll.models import Poll, Response, ResponseCategory, Category, Rule,Translation, ActivePoll, StartProgress, gettext_db, \
+    start_poll_partition, ReprocessJob, ResponseCount, ExportJob
 from rapidsms_httprouter.router import get_router
 from rapidsms_httprouter.models import Message, MessageBatch
 from django.utils import translation
@@ -28,6 +47,80 @@ class BasicPatternTemplateTest(TestCase):
         self.failIf(rx.search('some text and then i say my '))
         self.failIf(rx.search('myopic'))
 
+class CategorizerTest(TestCase):
+    def test_categorize(self):
+        yes = Category(pk=1, name='yes')
+        no = Category(pk=2, name='no')
+        unknown = Category(pk=3, name='unknown', default=True)
+        categorizer = Categorizer([no, unknown, yes], [
+            (1, STARTSWITH_PATTERN_TEMPLATE % 'yes|y'),
+            (2, STARTSWITH_PATTERN_TEMPLATE % 'no|n'),
+            (2, '^nope'),
+        ])
+        self.assertEqual(categorizer.default, unknown)
+        self.assertEqual(categorizer.categorize('YES please'), [yes])
+        self.assertEqual(categorizer.categorize('nope'), [no])
+        self.assertEqual(categorizer.categorize('maybe'), [])
+        self.assertEqual(categorizer.categorize(None), [])
+
+    def test_keyword_rules_match_like_their_regexes(self):
+        categories = [Category(pk=pk, name=str(pk)) for pk in range(1, 6)]
+        rules = [
+            (1, STARTSWITH_PATTERN_TEMPLATE % 'yes|yeah|y'),
+            (2, CONTAINS_PATTERN_TEMPLATE % 'apple|pie'),
+            (3, Rule(rule=Rule.contains_all_of, rule_string='good,day').get_regex()),
+            (4, Rule(rule=Rule.contains_one_of, rule_string="bad,don't").get_regex()),
+            (5, STARTSWITH_PATTERN_TEMPLATE % 'y[a-z]s'),
+        ]
+        keywords = Categorizer(categories, rules)
+        regexes = Categorizer(categories, rules)
+        regexes.automaton = None
+        self.failIf(keywords.automaton is None)
+        for text in ['yes', ' Yeah!', 'yesterday', 'yas', 'y', 'apple pie', 'pineapple', 'apples',
+                     'good day', 'day good', 'goodday', 'a good\nday', 'bad', 'badly', "don't go", '']:
+            self.assertEqual(keywords.categorize(text), regexes.categorize(text), text)
+
+    def test_gives_up_after_time_budget(self):
+        slow = Category(pk=1, name='slow')
+        unknown = Category(pk=2, name='unknown', default=True)
+        categorizer = Categorizer([slow, unknown], [(1, '(a+)+$'), (1, 'never')], time_budget=0.001)
+        self.assertEqual(categorizer.categorize('a' * 20 + '!'), [unknown])
+
+class RuleGuardTest(TestCase):
+    def test_rule_cost(self):
+        self.assertEqual(rule_cost(r'(\w+\s?)+$', adversarial_texts(), 0.5), None)
+        self.failIf(rule_cost(STARTSWITH_PATTERN_TEMPLATE % 'yes|y', adversarial_texts(), 0.5) is None)
+
+    def test_catastrophic_patterns(self):
+        # fast enough on short texts, but not on an SMS of digits, and only
+        # slow on texts made of the pattern's own characters
+        for regex in [r'^(\d+)*$', r'(x+x+)+y']:
+            self.failIf(is_fast_enough(regex), regex)
+        self.failUnless(is_fast_enough(STARTSWITH_PATTERN_TEMPLATE % 'yes|y'))
+        self.failUnless(is_fast_enough(Rule(rule=Rule.contains_all_of, rule_string='good,day').get_regex()))
+
+    def test_slow_rules_are_kept_out(self):
+        user = User.objects.create_user('admin', 'c@c.com', 'admin')
+        p = Poll.create_with_bulk('test poll1', Poll.TYPE_TEXT, 'test?', 'test!', Contact.objects.none(), user)
+        category = Category.objects.create(name='words', poll=p)
+        slow = r'(\w+\s?)+$'
+        self.assertRaises(ValidationError, Rule.objects.create, category=category, rule_type=Rule.TYPE_REGEX,
+                          rule_string=slow, regex=slow)
+        # stored before saving checked them
+        rule = Rule.objects.create(category=category, rule_type=Rule.TYPE_REGEX, rule_string='words', regex='words')
+        Rule.objects.filter(pk=rule.pk).update(rule_string=slow, regex=slow)
+        self.assertEqual(p.build_categorizer().rules, [])
+
+class LocationIndexTest(TestCase):
+    def test_matches_like_get_close_matches(self):
+        names = ['Kampala', 'Gulu', 'Arua', 'Kabale', 'Kabarole', 'Masaka', 'Mbarara', 'Kasese', 'Lira']
+        index = LocationIndex(enumerate(names))
+        lower = [n.lower() for n in names]
+        for text in ['kampala', 'Kampla ', 'gulu.', 'kabal', 'kabarol', 'mbarra', 'xyz', 'lira1', '']:
+            matches = difflib.get_close_matches(text.lower(), lower)
+            expected = lower.index(matches[0]) if matches else None
+            self.assertEqual(index.match(text), expected, text)
+
 class TestScript(TestCase):
 
     def fake_incoming(self,connection, incoming_message):
@@ -98,6 +191,156 @@ class ProcessingTests(TestScript):
         # we just sent in
         self.assertEqual(Response.objects.filter(poll__type=Poll.TYPE_NUMERIC)[0].eav.poll_number_value, 3.1415)
 
+    def test_active_poll_follows_start_and_end(self):
+        p1 = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'test?',
+                'test!',
+                Contact.objects.all(),
+                self.user)
+        self.assertRaises(Poll.DoesNotExist, ActivePoll.objects.get_poll_for, self.contact1)
+        p1.start()
+        self.assertEqual(ActivePoll.objects.get_poll_for(self.contact1), p1)
+
+        p2 = Poll.create_with_bulk(
+                'test poll2',
+                Poll.TYPE_TEXT,
+                'test again?',
+                'test!',
+                Contact.objects.filter(pk__in=[self.contact1.pk]),
+                self.user)
+        p2.start()
+        self.assertEqual(ActivePoll.objects.get_poll_for(self.contact1), p2)
+        self.assertEqual(ActivePoll.objects.get_poll_for(self.contact2), p1)
+
+        # once the newer poll ends, contact1 falls back to the older one
+        p2.end()
+        self.assertEqual(ActivePoll.objects.get_poll_for(self.contact1), p1)
+        p1.end()
+        self.assertRaises(Poll.DoesNotExist, ActivePoll.objects.get_poll_for, self.contact2)
+
+    def test_active_poll_one_row_per_contact(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'test?',
+                'test!',
+                Contact.objects.all(),
+                self.user)
+        p.start()
+        self.assertEqual(ActivePoll.objects.filter(contact=self.contact1).count(), 1)
+        self.assertFalse(try_insert(ActivePoll.objects.create, contact=self.contact1, poll=None))
+        # a lookup racing a poll start finds the row already there
+        self.assertEqual(ActivePoll.objects._resolve(self.contact1), p.pk)
+        self.assertEqual(ActivePoll.objects.filter(contact=self.contact1).count(), 1)
+        self.assertEqual(ActivePoll.objects.get_poll_for(self.contact1), p)
+
+    def test_active_poll_cache(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'test?',
+                'test!',
+                Contact.objects.all(),
+                self.user)
+        cache = VersionedCache('test')
+        with self.settings(POLL_SHARED_CACHE=False):
+            cache.set('key', 'value')
+            self.assertEqual(cache.get('key'), None)
+            # unless out of date entries are acceptable for a while
+            timed = VersionedCache('test-timed', local_timeout=60)
+            timed.set('key', 'value')
+            self.assertEqual(timed.get('key'), 'value')
+            timed.local_timeout = 0
+            self.assertEqual(timed.get('key'), None)
+        with self.settings(POLL_SHARED_CACHE=True):
+            cache.set('key', 'value')
+            self.assertEqual(cache.get('key'), 'value')
+
+            self.assertRaises(Poll.DoesNotExist, ActivePoll.objects.get_poll_for, self.contact1)
+            # started by another process, whose invalidation this one missed
+            Poll.objects.filter(pk=p.pk).update(start_date=datetime.datetime.now())
+            ActivePoll.objects.filter(contact=self.contact1).update(poll=p)
+            self.assertEqual(ActivePoll.objects.get_poll_for(self.contact1), p)
+
+    def test_streaming_start(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'test?',
+                'test!',
+                Contact.objects.all(),
+                self.user)
+        p.start_streaming(chunk_size=1)
+        self.assertEquals(Message.objects.filter(direction='O', text='test?').count(), 2)
+        self.assertEquals(p.messages.count(), 2)
+        progress = p.start_progress.get()
+        self.assertEquals((progress.recipients, progress.sent, progress.chunks), (2, 2, 2))
+        self.assertTrue(progress.completed)
+        self.assertEqual(ActivePoll.objects.get_poll_for(self.contact2), p)
+
+    def test_resume_interrupted_start(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'test?',
+                'test!',
+                Contact.objects.all(),
+                self.user)
+        # a start that died after committing the first connection's chunk
+        first, second = Connection.objects.order_by('pk')
+        p.start_date = datetime.datetime.now()
+        p.save()
+        StartProgress.objects.create(poll=p, recipients=2, sent=1, chunks=1, last_connection=first.pk)
+
+        p.start_streaming()
+        self.assertEquals(Message.objects.filter(direction='O').count(), 0)
+
+        p.resume_start(chunk_size=1)
+        self.assertEquals(list(Message.objects.filter(direction='O').values_list('connection', flat=True)), [second.pk])
+        progress = p.start_progress.get()
+        self.assertEquals((progress.sent, progress.last_connection), (2, second.pk))
+        self.assertTrue(progress.completed)
+        self.assertEquals(p.get_incomplete_start(), None)
+
+    def test_parallel_start_partitions(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'test?',
+                'test!',
+                Contact.objects.all(),
+                self.user)
+        first, second = Connection.objects.order_by('pk')
+        progresses = p._start_partitions(2)
+        self.assertEquals([(pr.last_connection, pr.upper, pr.recipients) for pr in progresses],
+                          [(0, first.pk, 1), (first.pk, second.pk, 1)])
+
+        # batches are held until the last partition completes
+        start_poll_partition(progresses[1].pk, 10)
+        self.assertEquals(Message.objects.filter(direction='O').count(), 1)
+        self.assertEquals(MessageBatch.objects.get(name=p.get_outgoing_message_batch_name()).status, 'P')
+        start_poll_partition(progresses[0].pk, 10)
+        self.assertEquals(p.messages.count(), 2)
+        self.assertEquals(set(MessageBatch.objects.filter(name=p.get_outgoing_message_batch_name())
+                              .values_list('status', flat=True)), set(['Q']))
+        self.assertEquals(p.start_progress.filter(completed=None).count(), 0)
+
+    def test_add_contacts(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'test?',
+                'test!',
+                Contact.objects.filter(pk=self.contact1.pk),
+                self.user)
+        self.assertEquals(list(p.contacts.all()), [self.contact1])
+        # contacts already in the poll are not added twice
+        self.assertEquals(p.add_contacts(Contact.objects.all()), 1)
+        self.assertEquals(p.contacts.count(), 2)
+        self.assertEquals(p.add_contacts(Contact.objects.none()), 0)
+
     def test_yes_no_polls(self):
         p = Poll.create_with_bulk(
                 'test poll1',
@@ -112,6 +355,332 @@ class ProcessingTests(TestScript):
         self.assertEqual(Response.objects.filter(poll=p).count(), 1)
         self.assertEqual(Response.objects.get(poll=p).categories.all()[0].category.name, 'yes')
 
+    def test_bulk_responses(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        messages = [Message.objects.create(connection=self.connection1, text='yes', direction='I', status='H'),
+                    Message.objects.create(connection=self.connection2, text='no way', direction='I', status='H'),
+                    Message.objects.create(connection=self.connection2, text='what?', direction='I', status='H')]
+        results = p.process_responses_bulk(messages)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(Response.objects.filter(poll=p).count(), 3)
+        self.assertEqual([r.categories.get().category.name for r, outgoing in results], ['yes', 'no', 'unknown'])
+        self.assertEqual(results[1][0].eav.poll_text_value, 'no way')
+        self.assertEqual(results[0][1], 'glad to know where you are!')
+
+    def test_bulk_responses_repeated_message(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        message = Message.objects.create(connection=self.connection1, text='yes', direction='I', status='H')
+        results = p.process_responses_bulk([message, message])
+        self.assertEqual(len(set([r.pk for r, outgoing in results])), 2)
+        for response in Response.objects.filter(poll=p):
+            self.assertEqual(response.categories.get().category.name, 'yes')
+            self.assertEqual(response.eav.poll_text_value, 'yes')
+
+    def test_materialized_counts(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        self.assertTrue(p.counts_materialized)
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'no', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'what?', 'glad to know where you are!', TestScript.SHOULD_NOT_HAVE_RESPONSE)
+
+        def counts(poll):
+            return dict([(d['category__name'], d['value']) for d in poll.responses_by_category()])
+
+        p = Poll.objects.get(pk=p.pk)
+        self.assertEqual(counts(p), {'yes': 1, 'no': 1, 'unknown': 1})
+        r = Response.objects.get(poll=p, message__text='yes')
+        r.update_categories([Category.objects.get(poll=p, name='no')], self.user)
+        self.assertEqual(counts(p), {'no': 2, 'unknown': 1})
+
+        ResponseCount.objects.rebuild(p)
+        self.assertEqual(counts(p), {'no': 2, 'unknown': 1})
+        p.counts_materialized = False
+        self.assertEqual(counts(p), {'no': 2, 'unknown': 1})
+
+    def test_materialized_counts_one_response(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.response_type = Poll.RESPONSE_TYPE_ONE
+        p.add_yesno_categories()
+        p.save()
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        # the new answer replaces the old one, in the counts too
+        self.assertInteraction(self.connection1, 'no', 'glad to know where you are!')
+        self.assertEqual(Response.objects.filter(poll=p).count(), 1)
+
+        p = Poll.objects.get(pk=p.pk)
+        self.assertTrue(p.counts_materialized)
+        self.assertEqual(dict([(d['category__name'], d['value']) for d in p.responses_by_category()]), {'no': 1})
+        self.assertEqual(sum(ResponseCount.objects.filter(poll=p).values_list('count', flat=True)), 1)
+
+    def test_location_rollups(self):
+        country = Location.objects.create(name='Uganda', code='ug')
+        kampala = Location.objects.create(name='Kampala', code='kla', tree_parent=country)
+        gulu = Location.objects.create(name='Gulu', code='gulu', tree_parent=country)
+        Location.objects.create(name='Elsewhere', code='else')
+        self.contact1.reporting_location = Location.objects.create(name='Nakawa', code='nkw', tree_parent=kampala)
+        self.contact1.save()
+        self.contact2.reporting_location = gulu
+        self.contact2.save()
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        Category.objects.filter(poll=p, name='unknown').delete()
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'no', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'what?', '', TestScript.SHOULD_NOT_HAVE_RESPONSE)
+
+        expected = {
+            Location.objects.get(pk=kampala.pk): {'total': 1, 'yes': 1, 'no': 0, 'uncategorized': 0},
+            Location.objects.get(pk=gulu.pk): {'total': 2, 'yes': 0, 'no': 1, 'uncategorized': 1},
+        }
+        p = Poll.objects.get(pk=p.pk)
+        self.assertFalse(p.counts_materialized)
+        self.assertEqual(p.simple_responses_by_category(Location.objects.get(pk=country.pk)), expected)
+        ResponseCount.objects.rebuild(p)
+        self.assertEqual(p.simple_responses_by_category(Location.objects.get(pk=country.pk)), expected)
+
+        rows = p.category_report_rows([country])
+        self.assertEqual([(row['location_name'], [d[2] for d in row['report_data']]) for row in rows],
+                         [('Gulu', [1, 0, 1]), ('Kampala', [0, 1, 0])])
+        self.assertEqual(rows[0]['report_data'][0][3], 50.0)
+
+    @override_settings(POLL_SHARED_CACHE=True)
+    def test_report_cache(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return p.responses_by_category()
+
+        hits = report_cache_stats()['hits']
+        self.assertEqual(get_report(p.pk, 'stats', compute), [])
+        self.assertEqual(get_report(p.pk, 'stats', compute), [])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(report_cache_stats()['hits'], hits + 1)
+
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        self.assertEqual(get_report(p.pk, 'stats', compute)[0]['value'], 1)
+        self.assertEqual(len(calls), 2)
+
+        # gender and age reports depend on the details of who responded
+        self.contact1.gender = 'F'
+        self.contact1.save()
+        get_report(p.pk, 'stats', compute)
+        self.assertEqual(len(calls), 3)
+
+    @override_settings(POLL_SHARED_CACHE=False)
+    def test_report_cache_not_shared(self):
+        self.contact1.gender = 'M'
+        self.contact1.save()
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+
+        def compute():
+            return list(p.responses_by_gender('f'))
+
+        self.assertEqual(get_report(p.pk, 'gender', compute, params=('f',)), [])
+        # changed by another process, whose invalidation never gets here
+        Contact.objects.filter(pk=self.contact1.pk).update(gender='F')
+        self.assertEqual(len(get_report(p.pk, 'gender', compute, params=('f',))), 1)
+
+    def test_csv_export(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'no, "really"', 'glad to know where you are!')
+
+        lines = ''.join(iter_responses_csv(p, chunk_size=1)).splitlines()
+        self.assertEqual(lines[0], 'sender,time,value,categories')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('Test McTesterton,'))
+        self.assertTrue(lines[1].endswith(',"no, ""really""","no,"'))
+        self.assertTrue(lines[2].endswith(',yes,"yes,"'))
+
+    @override_settings(POLL_EXPORT_CURSOR_LAG=0)
+    def test_incremental_export(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'no', 'glad to know where you are!')
+
+        rows, cursor = changed_responses(p)
+        self.assertEqual([row['value'] for row in rows], ['yes', 'no'])
+        self.assertEqual(changed_responses(p, cursor), ([], cursor))
+
+        r = Response.objects.get(pk=rows[0]['id'])
+        r.update_categories([Category.objects.get(poll=p, name='no')], self.user)
+        rows, cursor = changed_responses(p, cursor)
+        self.assertEqual([(row['id'], row['categories'][0][1]) for row in rows], [(r.pk, 'no')])
+
+        rows, pk_cursor = changed_responses(p, str(r.pk))
+        self.assertEqual([row['value'] for row in rows], ['no'])
+        self.assertEqual(pk_cursor, str(rows[0]['id']))
+        self.assertRaises(ValueError, changed_responses, p, 'yesterday')
+
+        # renaming or deleting a category changes its responses
+        category = Category.objects.get(poll=p, name='no')
+        category.name = 'nope'
+        category.save()
+        rows, cursor = changed_responses(p, cursor)
+        self.assertEqual([row['categories'][0][1] for row in rows], ['nope', 'nope'])
+        category.delete()
+        rows, cursor = changed_responses(p, cursor)
+        self.assertEqual([row['categories'] for row in rows], [[], []])
+
+        # nothing younger than the lag is handed out yet
+        with self.settings(POLL_EXPORT_CURSOR_LAG=300):
+            self.assertEqual(changed_responses(p), ([], ''))
+            self.assertEqual(changed_responses(p, '0'), ([], '0'))
+
+    def test_response_listing(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'no', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'yes', 'glad to know where you are!')
+
+        responses, cursor = response_page(p, page_size=2)
+        self.assertEqual(len(responses), 2)
+        with self.assertNumQueries(0):
+            rows = [(r.eav.poll_text_value, [rc.category.name for rc in r.categories.all()],
+                     r.message.connection.identity, r.poll.type,
+                     r.message.connection.contact.reporting_location) for r in responses]
+        self.assertEqual(rows[0], ('yes', ['yes'], '5555555', Poll.TYPE_TEXT, None))
+
+        older, last_cursor = response_page(p, cursor, page_size=2)
+        self.assertEqual(len(older), 1)
+        self.assertEqual(last_cursor, None)
+        self.assertEqual(set([r.pk for r in responses + older]), set(p.responses.values_list('pk', flat=True)))
+        self.assertRaises(ValueError, response_page, p, 'yesterday')
+
+    @skipIf(columnar.numpy is None, "numpy is not installed")
+    def test_columnar_export(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'no', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'yes', 'glad to know where you are!')
+
+        columns = columnar.build_columns(p, chunk_size=2)
+        self.assertEqual(list(columns['contact_id']), [self.contact1.pk, self.contact2.pk, self.contact2.pk])
+        texts = columns['value_text_dictionary'][columns['value_text']]
+        self.assertEqual(list(texts), ['yes', 'no', 'yes'])
+        self.assertEqual(len(columns['value_text_dictionary']), 2)
+        self.assertEqual(list(columns['category_offsets']), [0, 1, 2, 3])
+        names = dict(zip(columns['category_dictionary_id'], columns['category_dictionary_name']))
+        self.assertEqual([names[c] for c in columns['category_ids']], ['yes', 'no', 'yes'])
+
+    def test_export_jobs(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you there?',
+                'glad to know where you are!',
+                Contact.objects.all(),
+                self.user)
+        p.add_yesno_categories()
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'glad to know where you are!')
+        self.assertInteraction(self.connection2, 'no', 'glad to know where you are!')
+
+        root = tempfile.mkdtemp()
+        try:
+            with self.settings(POLL_EXPORT_ROOT=root):
+                job = ExportJob.objects.create(poll=p, fingerprint=ExportJob.fingerprint(p))
+                job.run()
+            job = ExportJob.objects.get(pk=job.pk)
+            self.assertEqual((job.status, job.rows), (ExportJob.STATUS_DONE, 2))
+            self.assertEqual(job.size, os.path.getsize(job.path))
+            self.assertEqual(gzip.open(job.path).read(), ''.join(iter_responses_csv(p)))
+            self.assertEqual(ExportJob.objects.request(p).pk, job.pk)
+
+            self.assertInteraction(self.connection2, 'yes', 'glad to know where you are!')
+            self.assertNotEqual(ExportJob.fingerprint(p), job.fingerprint)
+        finally:
+            shutil.rmtree(root)
+
     def test_numeric_polls(self):
         p = Poll.create_with_bulk(
                 'test poll numeric',
@@ -174,6 +743,151 @@ class ProcessingTests(TestScript):
 
         self.assertEquals(r7.categories.count(), 0, "number of r7 response categories should be 0")
 
+    def test_reprocess_sets_default_and_errors(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'are you hungry?',
+                'thanks!',
+                Contact.objects.all(),
+                self.user)
+        p.start()
+        self.assertInteraction(self.connection1, 'yes', 'thanks!')
+        r1 = Response.objects.order_by('-pk')[0]
+        self.assertInteraction(self.connection2, 'maybe', 'thanks!')
+        r2 = Response.objects.order_by('-pk')[0]
+
+        p.add_yesno_categories()
+        p.reprocess_responses()
+        r1, r2 = Response.objects.get(pk=r1.pk), Response.objects.get(pk=r2.pk)
+        self.assertEqual([rc.category.name for rc in r1.categories.all()], ['yes'])
+        self.assertFalse(r1.has_errors)
+        self.assertEqual([rc.category.name for rc in r2.categories.all()], ['unknown'])
+        self.assertTrue(r2.has_errors)
+
+        # running it again changes nothing
+        p.reprocess_responses()
+        self.assertEqual(ResponseCategory.objects.filter(response__poll=p).count(), 2)
+
+    def test_incremental_recategorization(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'whats your favorite food?',
+                'thanks!',
+                Contact.objects.all(),
+                self.user)
+        p.start()
+        self.assertInteraction(self.connection1, 'apples', 'thanks!')
+        r1 = Response.objects.order_by('-pk')[0]
+        self.assertInteraction(self.connection2, 'pizza', 'thanks!')
+        r2 = Response.objects.order_by('-pk')[0]
+        self.assertInteraction(self.connection2, 'apples pizza', 'thanks!')
+        r3 = Response.objects.order_by('-pk')[0]
+
+        healthy = Category.objects.create(name='healthy', poll=p)
+        junk = Category.objects.create(name='junk', poll=p)
+        r3.update_categories([junk], self.user)
+
+        rule = Rule.objects.create(category=healthy, rule_type=Rule.TYPE_CONTAINS, rule_string='apples')
+        rule.update_regex()
+        rule.save()
+        p.reprocess_rule_change(new_regex=rule.regex)
+        self.assertEqual([rc.category for rc in r1.categories.all()], [healthy])
+        self.assertEqual(r2.categories.count(), 0)
+        self.assertEqual(set(rc.category for rc in r3.categories.all()), set([healthy, junk]))
+
+        old_regex = rule.regex
+        rule.rule_string = 'pizza'
+        rule.update_regex()
+        rule.save()
+        p.reprocess_rule_change(old_regex=old_regex, new_regex=rule.regex)
+        self.assertEqual(r1.categories.count(), 0)
+        self.assertEqual([rc.category for rc in r2.categories.all()], [healthy])
+        # overrides are kept
+        self.assertEqual(set(rc.category for rc in r3.categories.all()), set([healthy, junk]))
+
+    def test_rule_change_categorizes_textless_responses(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_NUMERIC,
+                'how old are you?',
+                '#test!',
+                Contact.objects.all(),
+                self.user)
+        p.start()
+        self.assertInteraction(self.connection1, '42', '#test!')
+        r = Response.objects.get(poll=p)
+        self.assertEqual(r.eav.poll_text_value, None)
+        self.assertEqual(r.categories.count(), 0)
+
+        unknown = Category.objects.create(name='unknown', poll=p, default=True)
+        p.reprocess_rule_change(new_regex=CONTAINS_PATTERN_TEMPLATE % 'apples')
+        self.assertEqual([rc.category for rc in r.categories.all()], [unknown])
+
+    def test_reprocess_jobs_absorb_later_edits(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'whats your favorite food?',
+                'thanks!',
+                Contact.objects.all(),
+                self.user)
+        p.start()
+        self.assertInteraction(self.connection1, 'apples', 'thanks!')
+        r1 = Response.objects.order_by('-pk')[0]
+        self.assertInteraction(self.connection2, 'pizza', 'thanks!')
+        r2 = Response.objects.order_by('-pk')[0]
+
+        healthy = Category.objects.create(name='healthy', poll=p)
+        junk = Category.objects.create(name='junk', poll=p)
+        queued = ReprocessJob.objects.create(poll=p, kind=ReprocessJob.KIND_UNCATEGORIZED)
+        for category, keyword in [(healthy, 'apples'), (junk, 'pizza')]:
+            rule = Rule.objects.create(category=category, rule_type=Rule.TYPE_CONTAINS, rule_string=keyword)
+            rule.update_regex()
+            rule.save()
+            job = ReprocessJob.objects.enqueue(p, ReprocessJob.KIND_RULES, [rule.regex])
+            self.assertEqual(job.pk, queued.pk)
+        self.assertEqual(ReprocessJob.objects.count(), 1)
+        self.assertEqual(len(job.get_regexes()), 2)
+
+        job.run()
+        job = ReprocessJob.objects.get(pk=job.pk)
+        self.assertEqual((job.kind, job.status, job.processed, job.total),
+                         (ReprocessJob.KIND_RULES, ReprocessJob.STATUS_DONE, 2, 2))
+        self.assertEqual([rc.category for rc in r1.categories.all()], [healthy])
+        self.assertEqual([rc.category for rc in r2.categories.all()], [junk])
+
+    def test_rule_preview(self):
+        p = Poll.create_with_bulk(
+                'test poll1',
+                Poll.TYPE_TEXT,
+                'whats your favorite food?',
+                'thanks!',
+                Contact.objects.all(),
+                self.user)
+        p.start()
+        for connection, text in [(self.connection1, 'apples'), (self.connection2, 'pizza'),
+                                 (self.connection1, 'apples pizza')]:
+            self.assertInteraction(connection, text, 'thanks!')
+        healthy = Category.objects.create(name='healthy', poll=p)
+        junk = Category.objects.create(name='junk', poll=p)
+        rule = Rule.objects.create(category=healthy, rule_type=Rule.TYPE_CONTAINS, rule_string='pizza')
+        rule.update_regex()
+        rule.save()
+        Rule.objects.create(category=junk, rule_type=Rule.TYPE_CONTAINS,
+                            regex=CONTAINS_PATTERN_TEMPLATE % 'pizza', rule_string='pizza')
+
+        preview = p.preview_rule(healthy, CONTAINS_PATTERN_TEMPLATE % 'apples', replaces=rule.pk)
+        self.assertEqual((preview['matched'], preview['lost'], preview['conflicts'], preview['scanned']),
+                         (1, 1, 1, 3))
+        self.assertEqual(preview['examples']['matched'], ['apples'])
+        self.assertEqual(preview['examples']['lost'], ['pizza'])
+        self.assertTrue(preview['complete'])
+        self.assertEqual(p.preview_rule(healthy, CONTAINS_PATTERN_TEMPLATE % 'apples', sample=1)['scanned'], 1)
+        # nothing was written
+        self.assertEqual(ResponseCategory.objects.filter(response__poll=p).count(), 0)
+
     def test_response_type_handling(self):
         #test allow all
         poll1 = Poll.create_with_bulk(
@@ -252,6 +966,20 @@ class ProcessingTests(TestScript):
         self.assertInteraction(self.connection2, 'no', 'Ureport mini kare me lok ikum jami matime i kama in ibedo iyee. Lagam mabejo kibiketo ne I karatac me ngec.')
         self.assertEquals(Message.objects.count(), 6)
         
+    def test_translations_are_reloaded_after_changes(self):
+        # cached per process with a shared cache backend, looked up each time
+        # without one
+        for shared in (True, False):
+            with self.settings(POLL_SHARED_CACHE=shared):
+                self.assertEqual(gettext_db(field='thanks!', language='ach'), 'thanks!')
+                t = Translation.objects.create(field='thanks!', language='ach', value='apwoyo!')
+                self.assertEqual(gettext_db(field='thanks!', language='ach'), 'apwoyo!')
+                t.value = 'apwoyo matek!'
+                t.save()
+                self.assertEqual(gettext_db(field='thanks!', language='ach'), 'apwoyo matek!')
+                t.delete()
+                self.assertEqual(gettext_db(field='thanks!', language='ach'), 'thanks!')
+
     def test_null_responses(self):
      
         no_response_poll = Poll.create_with_bulk(
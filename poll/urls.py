@@ -4,6 +4,8 @@ from . import views
 urlpatterns = patterns('',
     url(r"^$", views.polls, name="polls"),
     url(r"^(\d+)/submissions.csv$", views.responses_as_csv),    
+    url(r"^(\d+)/submissions.npz$", views.responses_as_npz),
+    url(r"^(\d+)/submissions/changes.csv$", views.responses_changed_as_csv),
     url(r"^new/$", views.new_poll),
     url(r"^(\d+)/responses/$", views.view_responses, name="poll-responses"),
     url(r"^(?P<poll_id>\d+)/responses/module/$", views.view_responses,  {'as_module':True}, name="poll-responses-module"),    
@@ -37,6 +39,12 @@ urlpatterns = patterns('',
     url(r"^(\d+)/category/(\d+)/rules/add/$", views.add_rule),    
     url(r"^(\d+)/category/(\d+)/rule/(\d+)/delete/$", views.delete_rule),
     url(r"^(\d+)/category/(\d+)/rules/$", views.view_rules),
+    url(r"^(\d+)/category/(\d+)/rules/preview/$", views.preview_rule),
     url(r"^(\d+)/categories/add/$", views.add_category),
+    url(r"^(?P<poll_id>\d+)/reprocess/$", views.reprocess, name="poll-reprocess"),
+    url(r"^(?P<poll_id>\d+)/reprocess/(?P<job_id>\d+)/$", views.reprocess_progress, name="poll-reprocess-progress"),
+    url(r"^(?P<poll_id>\d+)/export/$", views.export_responses, name="poll-export"),
+    url(r"^(?P<poll_id>\d+)/export/(?P<job_id>\d+)/$", views.export_progress, name="poll-export-progress"),
+    url(r"^(?P<poll_id>\d+)/export/(?P<job_id>\d+)/download/$", views.export_download, name="poll-export-download"),
     url(r"^(\d+)/demo/", views.demo, name="demo"),
 )
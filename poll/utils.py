@@ -0,0 +1,140 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction, IntegrityError
+
+
+# how long a cache version is remembered by the django cache backend; if it
+# expires every process simply drops its local copy on the next lookup
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def cache_is_shared():
+    """
+    Whether every process talks to the same django cache backend, so that a
+    version bumped by one of them is seen by the others.  The local memory
+    and dummy backends aren't; POLL_SHARED_CACHE overrides the guess, e.g.
+    to enable the caches when a single process does all the routing.
+    """
+    shared = getattr(settings, 'POLL_SHARED_CACHE', None)
+    if shared is not None:
+        return shared
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+class VersionedCache(object):
+    """
+    A per-process dictionary which is emptied whenever its version is bumped.
+    The version itself lives in django's cache framework, so with a shared
+    backend (memcached, redis...) an invalidation made in one process (the web
+    UI, say) is picked up by every router process on its next lookup, at the
+    cost of a single cache read.  Without a shared backend invalidations
+    can't reach the other processes, so nothing is cached at all, or with a
+    ``local_timeout`` entries are kept that many seconds, for data that may
+    be a little out of date.
+    """
+
+    def __init__(self, name, max_size=None, local_timeout=None):
+        self.version_key = 'poll-cache-version-%s' % name
+        self.max_size = max_size
+        self.local_timeout = local_timeout
+        self.version = None
+        self.data = {}
+        # key -> (value, when it was set), without a shared backend
+        self.local = {}
+
+    def _check_version(self):
+        version = cache.get(self.version_key, 0)
+        if version != self.version:
+            self.data.clear()
+            self.version = version
+
+    def get(self, key, default=None):
+        if not cache_is_shared():
+            if self.local_timeout is None or key not in self.local:
+                return default
+            value, stored = self.local[key]
+            if time.time() - stored >= self.local_timeout:
+                del self.local[key]
+                return default
+            return value
+        self._check_version()
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        if not cache_is_shared():
+            if self.local_timeout is not None:
+                if self.max_size and len(self.local) >= self.max_size:
+                    self.local.clear()
+                self.local[key] = (value, time.time())
+            return
+        if self.max_size and len(self.data) >= self.max_size:
+            self.data.clear()
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        self.local.pop(key, None)
+
+    def invalidate(self):
+        # a fresh token rather than a counter, so that an expired version
+        # can never come back with a value some process already holds
+        cache.set(self.version_key, uuid.uuid4().hex, VERSION_TIMEOUT)
+        self.data.clear()
+        self.local.clear()
+
+
+def execute_sql(sql, params=()):
+    """
+    Runs a raw write statement against the default database, returning the
+    number of affected rows.
+    """
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+    return cursor.rowcount
+
+
+def try_insert(insert, *args, **kwargs):
+    """
+    Calls ``insert`` with the given arguments, returning False rather than
+    raising if it breaks a unique constraint.  Only the failed statement is
+    rolled back, so a surrounding transaction can carry on.
+    """
+    managed = transaction.is_managed()
+    sid = transaction.savepoint() if managed else None
+    try:
+        insert(*args, **kwargs)
+    except IntegrityError:
+        if managed:
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.rollback_unless_managed()
+        return False
+    if managed:
+        transaction.savepoint_commit(sid)
+    return True
+
+
+# rows per INSERT; keeps the number of query parameters within sqlite's limit
+BULK_BATCH_SIZE = 100
+
+
+def bulk_create(model, objs, batch_size=BULK_BATCH_SIZE):
+    """
+    Inserts ``objs`` with as few INSERT statements as the backend allows.
+    """
+    for i in range(0, len(objs), batch_size):
+        model.objects.bulk_create(objs[i:i + batch_size])
+
+
+def supports_insert_select():
+    """
+    Whether the default database is one INSERT ... SELECT statements are
+    known to work on; other backends get chunked bulk inserts instead.
+    """
+    return connection.vendor in ('postgresql', 'mysql', 'sqlite')
@@ -1,13 +1,23 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import re
+import tempfile
+
 from django.db import transaction
 from django.db.models import Q, Count
 from django.views.decorators.http import require_GET
 from django.template import RequestContext
 from django.shortcuts import redirect, get_object_or_404, \
     render_to_response
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.servers.basehttp import FileWrapper
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # before django 1.5 a plain response streams any iterator it is given
+    StreamingHttpResponse = HttpResponse
 from django.contrib.sites.models import Site
 from django.contrib.auth.decorators import login_required, \
     permission_required
@@ -15,7 +25,13 @@ from django.utils import simplejson
 from django.utils.safestring import mark_safe
 from rapidsms_httprouter.router import get_router
 from rapidsms.messages.outgoing import OutgoingMessage
-from models import Response,ResponseCategory
+from models import Response,ResponseCategory,ActivePoll,ReprocessJob,ResponseCount, \
+    rebuild_response_counts, ExportJob
+from report_cache import get_report
+from export import iter_responses_csv, changed_responses, \
+    changed_responses_csv
+import columnar
+from listing import response_page
 from rapidsms.contrib.locations.models import Location
 from rapidsms.models import Connection, Backend
 from eav.models import Attribute
@@ -33,17 +49,51 @@ from forms import *
 @require_GET
 def responses_as_csv(req, pk):
     poll = get_object_or_404(Poll, pk=pk)
+    resp = StreamingHttpResponse(iter_responses_csv(poll),
+                                 content_type='text/csv')
+    resp['Content-Disposition'] = 'attachment;filename="%s.csv"' \
+        % poll.name
+    return resp
 
-    responses = poll.responses.all().order_by('-pk')
 
-    resp = render_to_response('polls/responses.csv', {'responses'
-                              : responses}, mimetype='text/csv',
-                              context_instance=RequestContext(req))
-    resp['Content-Disposition'] = 'attachment;filename="%s.csv"' \
+@require_GET
+def responses_as_npz(req, pk):
+    poll = get_object_or_404(Poll, pk=pk)
+    try:
+        data = tempfile.TemporaryFile()
+        columnar.write_npz(poll, data)
+    except ImproperlyConfigured, e:
+        return HttpResponse(str(e), status=501, mimetype='text/plain')
+    size = data.tell()
+    data.seek(0)
+    resp = StreamingHttpResponse(FileWrapper(data),
+                                 content_type='application/octet-stream')
+    resp['Content-Length'] = size
+    resp['Content-Disposition'] = 'attachment;filename="%s.npz"' \
         % poll.name
     return resp
 
 
+@require_GET
+def responses_changed_as_csv(req, pk):
+    """
+    The responses added or recategorized since the ``since`` cursor, at
+    most ``limit`` of them; the cursor for the next request comes back in
+    the X-Next-Cursor header.
+    """
+    poll = get_object_or_404(Poll, pk=pk)
+    try:
+        limit = int(req.GET.get('limit', 0)) or None
+        (rows, next_cursor) = changed_responses(poll, req.GET.get('since'
+                ), limit)
+    except ValueError, e:
+        return HttpResponse(str(e), status=400, mimetype='text/plain')
+    resp = HttpResponse(changed_responses_csv(poll, rows),
+                        mimetype='text/csv')
+    resp['X-Next-Cursor'] = next_cursor
+    return resp
+
+
 @require_GET
 @login_required
 def polls(req):
@@ -191,15 +241,6 @@ def view_report(
         elif poll.type == Poll.TYPE_NUMERIC:
             template = 'polls/poll_report_numeric.html'
 
-    report_function = None
-    is_text_poll = True
-    if Poll.TYPE_CHOICES[poll.type]['db_type'] == Attribute.TYPE_TEXT:
-        report_function = poll.responses_by_category
-    elif Poll.TYPE_CHOICES[poll.type]['db_type'] \
-        == Attribute.TYPE_FLOAT:
-        report_function = poll.get_numeric_report_data
-        is_text_poll = False
-
     if location_id:
         locations = get_object_or_404(Location, pk=location_id)
         locations = [locations]
@@ -207,64 +248,27 @@ def view_report(
         locations = Location.tree.root_nodes().order_by('name'
                 ).distinct()
 
-
-    results = []
-    for location in locations:
-        report = report_function(location=location, for_map=False)
-        if len(report):
-            if is_text_poll:
-                offset = 0
-                while offset < len(report):
-
-                    # reset the current row
-
-                    row = \
-                        {'location_name': report[offset]['location_name'
-                         ], 'location_id': report[offset]['location_id'
-                         ]}
-                    data = []
-                    total = 0.0
-
-                    for c in poll.categories.order_by('name'):
-                        if offset < len(report) \
-                            and report[offset]['location_id'] \
-                            == row['location_id'] \
-                            and report[offset]['category__name'] \
-                            == c.name:
-                            total += report[offset]['value']
-                            data.append((report[offset]['category__name'
-                                    ], report[offset]['category__color'
-                                    ], report[offset]['value']))
-                            offset += 1
-                        else:
-                            data.append((c.name, c.color, 0))
-                    if offset < len(report) \
-                        and report[offset]['location_id'] \
-                        == row['location_id'] \
-                        and report[offset]['category__name'] \
-                        == 'uncategorized':
-                        total += report[offset]['value']
-                        data.append((report[offset]['category__name'],
-                                    report[offset]['category__color'],
-                                    report[offset]['value']))
-                        offset += 1
-                    else:
-                        data.append(('uncategorized', '', 0))
-                    percent_data = []
-                    for d in data:
-                        percent_data.append(d + (d[2] * 100.0 / total,
-                                ))
-                    row['report_data'] = percent_data
-                    results.append(row)
-            elif Poll.TYPE_CHOICES[poll.type]['db_type'] \
-                == Attribute.TYPE_FLOAT:
-                results = results + list(report)
+    def compute():
+        categories = list(poll.categories.order_by('name'))
+        results = []
+        if Poll.TYPE_CHOICES[poll.type]['db_type'] == Attribute.TYPE_TEXT:
+            results = poll.category_report_rows(locations, categories)
+        elif Poll.TYPE_CHOICES[poll.type]['db_type'] \
+            == Attribute.TYPE_FLOAT:
+            for location in locations:
+                results = results \
+                    + list(poll.get_numeric_report_data(location=location,
+                           for_map=False))
+        return (categories, results)
+
+    (categories, results) = get_report(poll.pk, 'report', compute,
+            location=location_id)
 
     breadcrumbs = (('Polls', reverse('polls')), )
     context = {
         'poll': poll,
         'breadcrumbs': breadcrumbs,
-        'categories': poll.categories.order_by('name'),
+        'categories': categories,
         'report_rows': results,
         'response_rate': response_rate,
         }
@@ -302,6 +306,7 @@ def edit_poll(req, poll_id):
         if form.is_valid():
             poll = form.save()
             poll.contacts = form.cleaned_data['contacts']
+            ActivePoll.objects.contacts_changed(poll)
             return render_to_response('polls/poll_details.html', {'poll'
                     : poll}, context_instance=RequestContext(req))
     else:
@@ -320,7 +325,10 @@ def edit_poll(req, poll_id):
 def view_responses(req, poll_id, as_module=False):
     poll = get_object_or_404(Poll, pk=poll_id)
 
-    responses = poll.responses.all().order_by('-date')
+    try:
+        (responses, next_cursor) = response_page(poll, req.GET.get('before'))
+    except ValueError, e:
+        return HttpResponse(str(e), status=400, mimetype='text/plain')
 
     breadcrumbs = (('Polls', reverse('polls')), ('Responses', ''))
 
@@ -332,6 +340,10 @@ def view_responses(req, poll_id, as_module=False):
     return render_to_response(template, {
         'poll': poll,
         'responses': responses,
+        'next_cursor': next_cursor,
+        'is_first_page': not req.GET.get('before'),
+        # pages stay in the view they are browsed from, module or not
+        'page_url': req.path,
         'breadcrumbs': breadcrumbs,
         'columns': typedef['report_columns'],
         'db_type': typedef['db_type'],
@@ -347,28 +359,38 @@ def stats(req, poll_id, location_id=None):
     json_response_data = {}
     json_response_data = {'layer_title': 'Survey:%s' % poll.name,
                           'layer_type': 'categorized',
-                          'data': list(poll.responses_by_category(location))}
+                          'data': get_report(poll.pk, 'stats',
+                          lambda : list(poll.responses_by_category(location)),
+                          location=location_id)}
     return HttpResponse(mark_safe(simplejson.dumps(json_response_data)))
 
 def gender_stats(req, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     gender = req.GET.get('gender', '')
-    try:
-        filtered_data = poll.responses_by_gender(gender)
-    except AssertionError:
-        filtered_data = []
+
+    def compute():
+        try:
+            return poll.responses_by_gender(gender)
+        except AssertionError:
+            return []
+
+    filtered_data = get_report(poll.pk, 'gender', compute, params=(gender,))
     return HttpResponse(mark_safe(simplejson.dumps(filtered_data)))
 
 def age_stats(req, poll_id):
     lower = int(req.GET.get('lower',0))
     upper = int(req.GET.get('upper',100))
     poll = get_object_or_404(Poll, pk=poll_id)
-    return HttpResponse(mark_safe(simplejson.dumps(poll.responses_by_age(lower,upper))))
+    data = get_report(poll.pk, 'age', lambda : poll.responses_by_age(lower,
+                      upper), params=(lower, upper))
+    return HttpResponse(mark_safe(simplejson.dumps(data)))
 
 
 def number_details(req, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
-    return HttpResponse(mark_safe(simplejson.dumps(list(poll.get_numeric_detailed_data()))))
+    data = get_report(poll.pk, 'number_details',
+                      lambda : list(poll.get_numeric_detailed_data()))
+    return HttpResponse(mark_safe(simplejson.dumps(data)))
 
 
 def _get_response_edit_form(response, data=None):
@@ -487,7 +509,9 @@ def edit_response(req, response_id):
         form = _get_response_edit_form(response, data=req.POST)
         if form.is_valid():
             if 'categories' in form.cleaned_data:
+                before = set(response.categories.values_list('category', flat=True))
                 ResponseCategory.objects.filter(response=response).delete()
+                ResponseCount.objects.record(poll, [(response.pk, before, set())])
                 response.update_categories(form.cleaned_data['categories'
                         ], req.user)
 
@@ -619,6 +643,10 @@ def delete_poll(req, poll_id):
         #delete translations of the poll first       
         Translation.objects.filter(field=poll.question).delete()
         
+        # its counts go with it, so don't keep them up to date for each
+        # response deleted along the way
+        Poll.objects.filter(pk=poll.pk).update(counts_materialized=False)
+
         #The finally delete the poll
         poll.delete()
 
@@ -657,6 +685,7 @@ def delete_category(req, poll_id, category_id):
 
     if req.method == 'POST':
         category.delete()
+        rebuild_response_counts.delay(poll.pk)
     return HttpResponse(status=200)
 
 
@@ -674,12 +703,11 @@ def edit_rule(
     rule = get_object_or_404(Rule, pk=rule_id)
 
     if req.method == 'POST':
-        form = RuleForm(req.POST, instance=rule)
-        if form.is_valid():
-            rule = form.save(commit=False)
-            rule.update_regex()
-            rule.save()
-            poll.reprocess_responses()
+        # the form updates the instance while validating
+        old_regex = rule.regex
+        form = RuleForm(req.POST, instance=rule, poll=poll)
+        if form.is_valid() and _save_rule(form):
+            ReprocessJob.objects.enqueue(poll, ReprocessJob.KIND_RULES, [old_regex, rule.regex])
             return render_to_response('polls/rule_view.html', {'rule'
                     : rule, 'poll': poll, 'category': category},
                     context_instance=RequestContext(req))
@@ -701,6 +729,21 @@ def edit_rule(
         }, context_instance=RequestContext(req))
 
 
+def _save_rule(form):
+    """
+    Saves the rule of a valid RuleForm, returning False with the error on
+    the form if Rule.save() still finds it too slow.
+    """
+    rule = form.save(commit=False)
+    rule.update_regex()
+    try:
+        rule.save()
+    except ValidationError, e:
+        form._errors['rule_string'] = form.error_class(e.messages)
+        return False
+    return True
+
+
 @login_required
 @permission_required('poll.can_edit_poll')
 def add_rule(req, poll_id, category_id):
@@ -711,13 +754,11 @@ def add_rule(req, poll_id, category_id):
     form = RuleForm()
 
     if req.method == 'POST':
-        form = RuleForm(req.POST)
-        if form.is_valid():
-            rule = form.save(commit=False)
-            rule.category = category
-            rule.update_regex()
-            rule.save()
-            poll.reprocess_responses()
+        form = RuleForm(req.POST, poll=poll)
+        form.instance.category = category
+        if form.is_valid() and _save_rule(form):
+            rule = form.instance
+            ReprocessJob.objects.enqueue(poll, ReprocessJob.KIND_RULES, [rule.regex])
             return render_to_response('polls/rule_view.html', {
                 'rule': rule,
                 'form': form,
@@ -732,6 +773,51 @@ def add_rule(req, poll_id, category_id):
                               context_instance=RequestContext(req))
 
 
+@login_required
+@permission_required('poll.can_edit_poll')
+def preview_rule(req, poll_id, category_id):
+    """
+    Returns as json what a rule submitted like to add_rule (plus the
+    contains_all_of/contains_one_of ``rule`` mode, and the ``rule_id`` of a
+    rule being edited) would change, without saving anything.  ``sample``
+    limits the preview to the latest responses and ``budget`` to a number
+    of seconds.
+    """
+    poll = get_object_or_404(Poll, pk=poll_id)
+    category = get_object_or_404(Category, pk=category_id, poll=poll)
+    invalid = HttpResponse(simplejson.dumps({'errors': {'__all__': ['Invalid rule']}}), status=400,
+                           mimetype='application/json')
+    try:
+        rule_mode = int(req.REQUEST.get('rule') or 0) or None
+    except ValueError:
+        return invalid
+    # the form checks the speed of the regex built for rule_mode, the one
+    # run below
+    form = RuleForm(req.REQUEST, poll=poll, rule_mode=rule_mode)
+    if not form.is_valid():
+        errors = dict((field, [unicode(e) for e in field_errors]) for field, field_errors in form.errors.items())
+        return HttpResponse(simplejson.dumps({'errors': errors}), status=400, mimetype='application/json')
+
+    rule = form.save(commit=False)
+    rule.category = category
+    try:
+        if rule_mode:
+            rule.rule = rule_mode
+            regex = rule.get_regex()
+        else:
+            rule.update_regex()
+            regex = rule.regex
+        re.compile(regex)
+        replaces = int(req.REQUEST.get('rule_id') or 0) or None
+        sample = int(req.REQUEST.get('sample') or 0) or None
+        budget = float(req.REQUEST.get('budget') or getattr(settings, 'POLL_PREVIEW_TIME_BUDGET', 10))
+    except (ValueError, TypeError, re.error):
+        return invalid
+
+    preview = poll.preview_rule(category, regex, replaces=replaces, sample=sample, time_budget=budget)
+    return HttpResponse(simplejson.dumps(preview), mimetype='application/json')
+
+
 @login_required
 def view_rule(
     req,
@@ -779,11 +865,72 @@ def delete_rule(
     rule = get_object_or_404(Rule, pk=rule_id)
     category = rule.category
     if req.method == 'POST':
+        old_regex = rule.regex
         rule.delete()
-    category.poll.reprocess_responses()
+        ReprocessJob.objects.enqueue(category.poll, ReprocessJob.KIND_RULES, [old_regex])
     return HttpResponse(status=200)
 
 
+@login_required
+@permission_required('poll.can_edit_poll')
+def reprocess(req, poll_id):
+    """
+    Queues the reprocessing of all of a poll's responses, or with
+    kind=uncategorized of those without a category, returning the job as
+    json.
+    """
+    poll = get_object_or_404(Poll, pk=poll_id)
+    if req.method != 'POST':
+        return HttpResponse(status=405)
+    if req.POST.get('kind') == 'uncategorized':
+        kind = ReprocessJob.KIND_UNCATEGORIZED
+    else:
+        kind = ReprocessJob.KIND_ALL
+    job = ReprocessJob.objects.enqueue(poll, kind)
+    return HttpResponse(simplejson.dumps(job.as_dict()), mimetype='application/json')
+
+
+@login_required
+def reprocess_progress(req, poll_id, job_id):
+    job = get_object_or_404(ReprocessJob, pk=job_id, poll__pk=poll_id)
+    return HttpResponse(simplejson.dumps(job.as_dict()), mimetype='application/json')
+
+
+@login_required
+def export_responses(req, poll_id):
+    """
+    Requests a background CSV export of a poll's responses, returning the
+    job as json; an unchanged poll gets its last export back.
+    """
+    poll = get_object_or_404(Poll, pk=poll_id)
+    if req.method != 'POST':
+        return HttpResponse(status=405)
+    job = ExportJob.objects.request(poll)
+    return HttpResponse(simplejson.dumps(job.as_dict()), mimetype='application/json')
+
+
+@login_required
+def export_progress(req, poll_id, job_id):
+    job = get_object_or_404(ExportJob, pk=job_id, poll__pk=poll_id)
+    return HttpResponse(simplejson.dumps(job.as_dict()), mimetype='application/json')
+
+
+@login_required
+def export_download(req, poll_id, job_id):
+    job = get_object_or_404(ExportJob, pk=job_id, poll__pk=poll_id,
+                            status=ExportJob.STATUS_DONE)
+    try:
+        data = open(job.path, 'rb')
+    except IOError:
+        raise Http404
+    resp = StreamingHttpResponse(FileWrapper(data),
+                                 content_type='application/x-gzip')
+    resp['Content-Length'] = job.size
+    resp['Content-Disposition'] = 'attachment;filename="%s.csv.gz"' \
+        % job.poll.name
+    return resp
+
+
 def create_translation(request):
     translation_form = PollTranslation()
     if request.method == 'POST':
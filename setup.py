@@ -7,6 +7,9 @@ setup(
 
     install_requires = ["rapidsms", 'django-uni-form', 'django-eav'],
 
+    # numpy is only needed for the columnar (.npz/.npy) response exports
+    extras_require = {'columnar': ['numpy']},
+
     dependency_links = [
         "http://github.com/mvpdev/django-eav/tarball/master#egg=django-eav",
     ],